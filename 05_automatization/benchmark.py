@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; -*-
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+def raise_open_files_limit():
+    # every client connection and its server side take a descriptor, subprocesses inherit the limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_server(engine, args):
+    command = [sys.executable, 'httpd.py', '-hs', '127.0.0.1', '-p', str(args.port), '-w', str(args.workers),
+               '-m', args.mode, '-e', engine, '--loop', args.loop, '-q']
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'{engine} server did not start on port {args.port}')
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            await reader.readexactly(int(line.split(b':', 1)[1]))
+            return head
+    raise RuntimeError('response without Content-Length')
+
+
+async def client_load(port, path, connections, requests):
+    # open all keep-alive connections first, then every connection sends its requests one after another
+    request = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode()
+    connecting = asyncio.Semaphore(100)
+    latencies = []
+    errors = 0
+
+    async def connect():
+        async with connecting:
+            return await asyncio.open_connection('127.0.0.1', port)
+
+    async def run_connection(reader, writer, count):
+        nonlocal errors
+        try:
+            for _ in range(count):
+                started = time.perf_counter()
+                writer.write(request)
+                await read_response(reader)
+                latencies.append(time.perf_counter() - started)
+        except (OSError, asyncio.IncompleteReadError, RuntimeError):
+            errors += 1
+        finally:
+            writer.close()
+
+    streams = await asyncio.gather(*[connect() for _ in range(connections)])
+    per_connection = [requests // connections + (i < requests % connections) for i in range(connections)]
+    started = time.perf_counter()
+    await asyncio.gather(*[run_connection(reader, writer, count)
+                           for (reader, writer), count in zip(streams, per_connection)])
+    return time.perf_counter() - started, latencies, errors
+
+
+def run_client(port, path, connections, requests):
+    raise_open_files_limit()
+    return asyncio.run(client_load(port, path, connections, requests))
+
+
+def percentile(sorted_values, share):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * share), len(sorted_values) - 1)]
+
+
+def bench_engine(engine, args):
+    server = start_server(engine, args)
+    try:
+        # clients in several processes so a single python client is not the bottleneck
+        jobs = [(args.port, args.path, args.connections // args.clients + (i < args.connections % args.clients),
+                 args.requests // args.clients + (i < args.requests % args.clients)) for i in range(args.clients)]
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.starmap(run_client, jobs)
+    finally:
+        stop_server(server)
+    elapsed = max(result[0] for result in results)
+    latencies = sorted(latency for result in results for latency in result[1])
+    return {'requests_per_sec': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'requests': len(latencies),
+            'failed_connections': sum(result[2] for result in results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OTUServer engines benchmark with many keep-alive connections")
+    parser.add_argument("--engines", nargs='+', default=['selectors', 'asyncio'], help="engines to compare")
+    parser.add_argument("--connections", type=int, default=1000, help="concurrent keep-alive connections")
+    parser.add_argument("--requests", type=int, default=50000, help="requests over all connections")
+    parser.add_argument("--clients", type=int, default=2, help="client processes")
+    parser.add_argument("--workers", type=int, default=1, help="server workers")
+    parser.add_argument("--mode", default="threads", help="server workers mode, threads or prefork")
+    parser.add_argument("--loop", default="asyncio", help="event loop for asyncio engine")
+    parser.add_argument("--path", default="/httptest/dir2/page.html", help="requested file")
+    parser.add_argument("--port", type=int, default=8080, help="port for server under test")
+    parser.add_argument("--output", default=None, help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    raise_open_files_limit()
+    engines = {engine: bench_engine(engine, args) for engine in args.engines}
+    result = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'cpus': os.cpu_count(),
+              'params': {'connections': args.connections, 'requests': args.requests, 'clients': args.clients,
+                         'workers': args.workers, 'mode': args.mode, 'loop': args.loop, 'path': args.path},
+              'engines': engines}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,73 @@
 #!/usr/bin/env python3
 
+import asyncio
+import importlib
 import socket
 import selectors
 import traceback
 import lib_for_http_server as lib_helper
 import os
 import argparse
+import signal
 import threading
 import logging
+import time
+
+# seconds for a stopping worker process to finish responses in progress
+GRACEFUL_TIMEOUT = 10
+# seconds between keep-alive timeout checks of all worker connections
+IDLE_SWEEP_INTERVAL = 1
 
 
 class MultiprocessSocketServer:
 
-    def __init__(self, host="", port=80, workers=5, rootdir=os.path.abspath("./doc_root")):
+    def __init__(self, host="", port=80, workers=5, rootdir=os.path.abspath("./doc_root"), keepalive_timeout=5,
+                 cache_size=64 * 1024 * 1024, mode="threads"):
         self.host = host
         self.port = port
         self.workers = workers
         self.rootdir = rootdir
+        # seconds to keep idle keep-alive connection, 0 - close after every response
+        self.keepalive_timeout = keepalive_timeout
         self.threads = []
+        # "threads" - worker threads share one listening socket,
+        # "prefork" - worker processes with own SO_REUSEPORT listening sockets
+        self.mode = mode
+        # prefork master: pid of worker process -> its start time
+        self.children = {}
+        # set by SIGTERM/SIGINT in prefork master and workers
+        self.stopping = False
+        # small files from rootdir in memory, shared by all worker threads
+        self.file_cache = lib_helper.StaticFileCache(cache_size) if cache_size else None
+
+    def close_idle_connections(self, sel, timeout=None):
+        now = time.monotonic()
+        timeout = self.keepalive_timeout if timeout is None else timeout
+        for key in list(sel.get_map().values()):
+            message = key.data
+            if message is not None and message.is_idle(now, timeout):
+                logging.debug(f'keep-alive timeout for {message.addr}')
+                message.close()
 
     def worker(self, lsock):
         sel = selectors.DefaultSelector()
         sel.register(lsock, selectors.EVENT_READ, data=None)
+        select_timeout = min(self.keepalive_timeout, 1) if self.keepalive_timeout else None
+        if self.mode == "prefork":
+            # wake up to notice shutdown
+            select_timeout = min(select_timeout or 1, 1)
+        deadline = None
+        last_sweep = time.monotonic()
         try:
             while True:
-                events = sel.select(timeout=None)
+                if self.stopping:
+                    if deadline is None:
+                        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+                        self.stop_accepting(sel, lsock)
+                    self.close_idle_connections(sel, timeout=0)
+                    if not sel.get_map() or time.monotonic() > deadline:
+                        break
+                events = sel.select(timeout=select_timeout)
                 for key, mask in events:
                     if key.data is None:
                         self.accept_wrapper(key.fileobj, sel)
@@ -36,11 +79,23 @@ class MultiprocessSocketServer:
                             logging.debug(
                                 f'main: error: exception for {message.addr}:\n{traceback.format_exc()}')
                             message.close()
+                if self.keepalive_timeout and time.monotonic() - last_sweep >= IDLE_SWEEP_INTERVAL:
+                    # sweep goes over every connection, not after each select
+                    self.close_idle_connections(sel)
+                    last_sweep = time.monotonic()
         except KeyboardInterrupt:
             print('caught keyboard interrupt, exiting')
         finally:
             sel.close()
 
+    @staticmethod
+    def stop_accepting(sel, lsock):
+        # new connections go to other workers, current ones are closed after their responses
+        sel.unregister(lsock)
+        lsock.close()
+        for key in sel.get_map().values():
+            key.data.keep_alive = False
+
     def accept_wrapper(self, sock, sel):
         rootdir = self.rootdir
         try:
@@ -49,16 +104,31 @@ class MultiprocessSocketServer:
             return
         logging.debug(f'accepted connection from {addr}')
         conn.setblocking(False)
-        message = lib_helper.Message(sel, conn, addr, rootdir)
+        # head and file body are sent separately, don't let Nagle hold the body tail
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        message = lib_helper.Message(sel, conn, addr, rootdir, keep_alive=bool(self.keepalive_timeout),
+                                     file_cache=self.file_cache)
         sel.register(conn, selectors.EVENT_READ, data=message)
 
-    def serve_forever(self):
+    def create_listener(self, reuse_port=False):
         lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Avoid bind() exception: OSError: [Errno 48] Address already in use
         lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # every worker process listens on the port, kernel balances connections between them
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         lsock.bind((self.host, self.port))
         lsock.listen()
+        # several workers wait on one socket, the ones that lost the race must not block in accept()
+        lsock.setblocking(False)
         logging.debug('listening on %s %s' % (self.host, self.port))
+        return lsock
+
+    def serve_forever(self):
+        if self.mode == "prefork":
+            self.serve_prefork()
+            return
+        lsock = self.create_listener()
         for _ in range(self.workers):
             t = threading.Thread(target=self.worker, args=(lsock,))
             t.start()
@@ -68,6 +138,102 @@ class MultiprocessSocketServer:
         for t in self.threads:
             t.join()
 
+    def serve_prefork(self):
+        if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+            raise RuntimeError("prefork mode needs os.fork and SO_REUSEPORT")
+        signal.signal(signal.SIGTERM, self.stop_children)
+        signal.signal(signal.SIGINT, self.stop_children)
+        for _ in range(self.workers):
+            self.spawn_worker()
+        logging.debug(f'Number of worker processes {len(self.children)}')
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logging.info(f'worker process {pid} exited with status {status}, restarting')
+            if time.monotonic() - started < 1:
+                # don't spin if worker fails right after start (e.g. can't bind)
+                time.sleep(1)
+            if not self.stopping:
+                self.spawn_worker()
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        exit_code = 0
+        try:
+            self.children = {}
+            signal.signal(signal.SIGTERM, self.stop_worker)
+            signal.signal(signal.SIGINT, self.stop_worker)
+            self.worker(self.create_listener(reuse_port=True))
+        except Exception:
+            logging.error(f'worker process {os.getpid()} failed:\n{traceback.format_exc()}')
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def stop_children(self, signum, frame):
+        # graceful shutdown: workers stop accepting and finish current responses
+        logging.info(f'got signal {signum}, stopping worker processes')
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def stop_worker(self, signum, frame):
+        self.stopping = True
+
+
+class AsyncioSocketServer(MultiprocessSocketServer):
+    """Same workers as MultiprocessSocketServer (threads or prefork processes),
+    each runs asyncio event loop with HTTPProtocol connections instead of selectors loop"""
+
+    def __init__(self, *args, loop="asyncio", **kwargs):
+        super().__init__(*args, **kwargs)
+        # "asyncio" or name of module with new_event_loop(), e.g. uvloop
+        self.loop = loop
+
+    def new_event_loop(self):
+        if self.loop == "asyncio":
+            return asyncio.new_event_loop()
+        return importlib.import_module(self.loop).new_event_loop()
+
+    def worker(self, lsock):
+        loop = self.new_event_loop()
+        try:
+            loop.run_until_complete(self.serve_socket(lsock))
+        except KeyboardInterrupt:
+            print('caught keyboard interrupt, exiting')
+        finally:
+            loop.close()
+
+    async def serve_socket(self, lsock):
+        loop = asyncio.get_running_loop()
+        connections = set()
+        file_cache = self.file_cache
+        keep_alive = bool(self.keepalive_timeout)
+        server = await loop.create_server(
+            lambda: lib_helper.HTTPProtocol(self.rootdir, keep_alive, file_cache, self.keepalive_timeout,
+                                            connections),
+            sock=lsock)
+        while not self.stopping:
+            await asyncio.sleep(1)
+        # new connections go to other workers, current ones are closed after their responses
+        server.close()
+        for protocol in list(connections):
+            protocol.stop()
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='OTUServer')
@@ -81,12 +247,36 @@ def parse_args():
     )
     parser.add_argument(
         '-w', '--workers', type=int, default=5,
-        help='server workers count, default - 5'
+        help='server workers count, threads or processes depending on --mode, default - 5'
     )
     parser.add_argument(
         '-r', '--root', type=str, default='doc_root',
         help='DIRECTORY_ROOT with site files, default - doc_root'
     )
+    parser.add_argument(
+        '-k', '--keepalive-timeout', type=float, default=5,
+        help='seconds to keep idle keep-alive connection, 0 - no keep-alive, default - 5'
+    )
+    parser.add_argument(
+        '-c', '--cache-size', type=float, default=64,
+        help='megabytes of memory for cached small files, 0 - no cache, default - 64'
+    )
+    parser.add_argument(
+        '-m', '--mode', choices=['threads', 'prefork'], default='threads',
+        help='threads sharing one socket or prefork worker processes with SO_REUSEPORT, default - threads'
+    )
+    parser.add_argument(
+        '-e', '--engine', choices=['selectors', 'asyncio'], default='selectors',
+        help='connections handling in every worker, default - selectors'
+    )
+    parser.add_argument(
+        '--loop', type=str, default='asyncio',
+        help='event loop for asyncio engine: asyncio or module with new_event_loop() like uvloop, default - asyncio'
+    )
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='log only INFO and above, default - DEBUG'
+    )
     return parser.parse_args()
 
 
@@ -94,7 +284,7 @@ if __name__ == "__main__":
     args = parse_args()
     config = {
                 "REPORT_LOG": None,
-                "DEBUG": True
+                "DEBUG": not args.quiet
               }
     logging.basicConfig(filename=config.get("REPORT_LOG", None),
                         level=logging.DEBUG if config.get("DEBUG", None) else logging.INFO,
@@ -104,6 +294,12 @@ if __name__ == "__main__":
                      port=args.port,
                      workers=args.workers,
                      rootdir=args.root,
+                     keepalive_timeout=args.keepalive_timeout,
+                     cache_size=int(args.cache_size * 1024 * 1024),
+                     mode=args.mode,
                      )
-    server = MultiprocessSocketServer(**init_args)
+    if args.engine == "asyncio":
+        server = AsyncioSocketServer(loop=args.loop, **init_args)
+    else:
+        server = MultiprocessSocketServer(**init_args)
     server.serve_forever()
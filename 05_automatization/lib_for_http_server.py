@@ -1,18 +1,93 @@
 import os
+import asyncio
 import selectors
 import datetime
 import mimetypes
 import re
+import stat
+import time
 import logging
+import threading
+import traceback
+from collections import deque, namedtuple, OrderedDict
+
+# smaller files are sent in one buffer with the head, larger ones with os.sendfile
+SENDFILE_MIN_SIZE = 64 * 1024
+
+# file from doc_root held in memory: head_block is status line and headers that don't change between responses
+CachedFile = namedtuple('CachedFile', ['path', 'body', 'size', 'content_type', 'head_block', 'mtime_ns', 'inode'])
+
+
+class StaticFileCache:
+    """Files from doc_root shared by all worker threads, LRU over max_bytes of bodies.
+    Every lookup does one os.stat and reloads the file if its mtime, inode or size changed"""
+
+    def __init__(self, max_bytes, max_file_size=SENDFILE_MIN_SIZE):
+        self.max_bytes = max_bytes
+        # files of max_file_size and larger go through os.sendfile and are not cached
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.files = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, format_head_block):
+        """CachedFile for path (index.html for directory) or None if path is not a cacheable file.
+        format_head_block(size, content_type) builds head_block of a loaded file"""
+        try:
+            st = os.stat(path)
+            if stat.S_ISDIR(st.st_mode):
+                path = os.path.join(path, 'index.html')
+                st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size >= self.max_file_size:
+            return None
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is not None and (cached.mtime_ns, cached.inode, cached.size) == \
+                    (st.st_mtime_ns, st.st_ino, st.st_size):
+                self.files.move_to_end(path)
+                return cached
+        return self._load(path, format_head_block)
+
+    def _load(self, path, format_head_block):
+        try:
+            with open(path, 'rb') as body_file:
+                st = os.fstat(body_file.fileno())
+                body = body_file.read()
+        except OSError:
+            return None
+        content_type = mimetypes.guess_type(path)[0]
+        cached = CachedFile(path, body, len(body), content_type, format_head_block(len(body), content_type),
+                            st.st_mtime_ns, st.st_ino)
+        if cached.size >= self.max_file_size:
+            # file grew after stat, it is sent by the usual path
+            return None
+        with self.lock:
+            old = self.files.pop(path, None)
+            if old is not None:
+                self.size -= old.size
+            self.files[path] = cached
+            self.size += cached.size
+            while self.size > self.max_bytes:
+                _, evicted = self.files.popitem(last=False)
+                self.size -= evicted.size
+        return cached
 
 
 class Message:
-    def __init__(self, selector, sock, addr, rootdir):
+    def __init__(self, selector, sock, addr, rootdir, keep_alive=True, file_cache=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
         self._recv_buffer = b''
         self._send_buffer = b''
+        # bytes of _send_buffer already sent, buffer is not re-sliced after partial send
+        self._send_offset = 0
+        # response body sent with os.sendfile after the head: open file, its offset and size
+        self._send_file = None
+        self._send_file_offset = 0
+        self._send_file_size = 0
         self.ac_in_buffer = b''
         self.incoming = []
         self.ac_in_buffer_size = 4096
@@ -20,8 +95,12 @@ class Message:
         self.method = None
         self.uri = None
         self.request = None
+        # complete requests read from socket, pipelined requests wait here
+        self.requests = deque()
         self.response_created = False
-        self.request_processor = HTTPRequestProcessor(rootdir)
+        self.keep_alive = keep_alive
+        self.last_activity = time.monotonic()
+        self.request_processor = HTTPRequestProcessor(rootdir, file_cache)
 
     def set_terminator (self, term):
         "Set the input delimiter.  Can be a fixed string of any length, an integer, or None"
@@ -36,6 +115,7 @@ class Message:
     # if found, transition to the next state.
     def found_terminator(self):
         self._recv_buffer = self._get_data()
+        self.requests.append(self._recv_buffer)
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -57,8 +137,12 @@ class Message:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self.ac_in_buffer += data
+            if not data:
+                # client closed connection
+                self.close()
+                return
+            self.ac_in_buffer += data
+            self.last_activity = time.monotonic()
 
         # Continue to search for self.terminator in self.ac_in_buffer,
         # while calling self.collect_incoming_data.  The while loop
@@ -128,19 +212,64 @@ class Message:
         return d
 
     def _write(self):
-        if self._send_buffer:
+        if self._send_offset < len(self._send_buffer):
             # print('sending', repr(self._send_buffer), 'to', self.addr)
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                sent = self.sock.send(memoryview(self._send_buffer)[self._send_offset:])
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
-                pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
-                # Close when the buffer is drained. The response has been sent.
-                if sent and not self._send_buffer:
+                return
+            self._send_offset += sent
+            self.last_activity = time.monotonic()
+            if self._send_offset < len(self._send_buffer):
+                return
+            self._send_buffer = b''
+            self._send_offset = 0
+        if self._send_file is not None:
+            # head is sent, the body goes from file to socket in kernel
+            try:
+                sent = os.sendfile(self.sock.fileno(), self._send_file.fileno(), self._send_file_offset,
+                                   self._send_file_size - self._send_file_offset)
+            except BlockingIOError:
+                return
+            self._send_file_offset += sent
+            self.last_activity = time.monotonic()
+            if not sent or self._send_file_offset >= self._send_file_size:
+                # file is sent or was truncated while sending (no way to keep Content-Length then)
+                truncated = self._send_file_offset < self._send_file_size
+                self._close_send_file()
+                if truncated:
                     self.close()
+                    return
+            else:
+                return
+        if self.response_created:
+            # The response has been sent when the buffer is drained.
+            self.finish_response()
+
+    def _close_send_file(self):
+        if self._send_file is not None:
+            self._send_file.close()
+            self._send_file = None
+            self._send_file_offset = self._send_file_size = 0
+
+    def finish_response(self):
+        # keep connection for the next request or close it
+        if not (self.keep_alive and self.request_processor.keep_alive):
+            self.close()
+            return
+        self.request = None
+        self.response_created = False
+        if self.requests:
+            # pipelined request is already read
+            self.process_request()
+        else:
+            self._set_selector_events_mask('r')
+
+    def is_idle(self, now, timeout):
+        # keep-alive connection waits for the next request longer than timeout
+        return self.request is None and not self._send_buffer and now - self.last_activity > timeout
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
@@ -150,17 +279,18 @@ class Message:
 
     def read(self):
         self._read()
-        if self.request is None:
+        if self.sock is not None and self.request is None and self.requests:
             self.process_request()
 
     def write(self):
-        if self.request:
+        if self.request is not None:
             if not self.response_created:
                 self.create_response()
         self._write()
 
     def close(self):
         logging.debug(f'closing connection to {self.addr}')
+        self._close_send_file()
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
@@ -177,7 +307,7 @@ class Message:
             self.sock = None
 
     def process_request(self):
-        self.request = self._recv_buffer
+        self.request = self.requests.popleft()
         logging.debug("request = %s" % self.request)
         self._set_selector_events_mask('w')
 
@@ -185,14 +315,126 @@ class Message:
         message = self._create_response(self.request)
         self.response_created = True
         self._send_buffer += message
+        self._send_file, self._send_file_size = self.request_processor.pop_response_file()
 
     def _create_response(self, request):
         return self.request_processor.create_response_for_message(request)
 
 
+class HTTPProtocol(asyncio.Protocol):
+    """Connection for asyncio engine: same requests handling as Message, buffering and writes done by the loop"""
+
+    def __init__(self, rootdir, keep_alive=True, file_cache=None, keepalive_timeout=5, connections=None):
+        self.transport = None
+        self.addr = None
+        self.buffer = bytearray()
+        self.keep_alive = keep_alive
+        self.keepalive_timeout = keepalive_timeout
+        # protocols of the server, used to stop them on shutdown
+        self.connections = connections if connections is not None else set()
+        # body of the last response goes with loop.sendfile, next requests wait in buffer
+        self.sending_file = False
+        self.last_activity = time.monotonic()
+        self.idle_handle = None
+        self.request_processor = HTTPRequestProcessor(rootdir, file_cache)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.connections.add(self)
+        logging.debug(f'accepted connection from {self.addr}')
+        if self.keep_alive and self.keepalive_timeout:
+            self.idle_handle = asyncio.get_running_loop().call_later(self.keepalive_timeout, self.check_idle)
+
+    def connection_lost(self, exc):
+        logging.debug(f'closing connection to {self.addr}')
+        self.connections.discard(self)
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.transport = None
+
+    def data_received(self, data):
+        self.buffer += data
+        self.last_activity = time.monotonic()
+        self.process_requests()
+
+    def process_requests(self):
+        # answer complete requests in buffer in order, pipelined ones too,
+        # requests after "Connection: close" are left unanswered
+        while self.transport is not None and not self.transport.is_closing() and not self.sending_file:
+            index = self.buffer.find(b"\r\n\r\n")
+            if index == -1:
+                return
+            request = bytes(self.buffer[:index])
+            del self.buffer[:index + 4]
+            logging.debug("request = %s" % request)
+            try:
+                self.send_response(request)
+            except Exception:
+                logging.debug(f'error: exception for {self.addr}:\n{traceback.format_exc()}')
+                self.transport.close()
+
+    def send_response(self, request):
+        response = self.request_processor.create_response_for_message(request)
+        response_file, size = self.request_processor.pop_response_file()
+        self.transport.write(response)
+        if response_file is not None:
+            self.sending_file = True
+            asyncio.get_running_loop().create_task(self.send_file(response_file, size))
+        else:
+            self.finish_response()
+
+    async def send_file(self, response_file, size):
+        try:
+            with response_file:
+                await asyncio.get_running_loop().sendfile(self.transport, response_file, 0, size)
+        except Exception:
+            logging.debug(f'error: sendfile exception for {self.addr}:\n{traceback.format_exc()}')
+            if self.transport is not None:
+                self.transport.close()
+            return
+        finally:
+            self.sending_file = False
+        self.last_activity = time.monotonic()
+        if self.finish_response():
+            self.process_requests()
+
+    def finish_response(self):
+        # True if connection is kept for the next request
+        if not (self.keep_alive and self.request_processor.keep_alive):
+            # buffered response is flushed before closing
+            self.transport.close()
+            return False
+        return True
+
+    def pause_writing(self):
+        # client doesn't read responses, stop reading its requests
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def check_idle(self):
+        if self.transport is None:
+            return
+        idle = time.monotonic() - self.last_activity
+        if idle >= self.keepalive_timeout and not self.sending_file:
+            logging.debug(f'keep-alive timeout for {self.addr}')
+            self.transport.close()
+        else:
+            self.idle_handle = asyncio.get_running_loop().call_later(
+                max(self.keepalive_timeout - idle, 0.1), self.check_idle)
+
+    def stop(self):
+        # server shutdown: close after the current response
+        self.keep_alive = False
+        if self.transport is not None and not self.sending_file and not self.buffer:
+            self.transport.close()
+
+
 class HTTPRequestProcessor:
 
-    def __init__(self, rootdir):
+    def __init__(self, rootdir, file_cache=None):
         self.responsecode = {"200": "OK",
                              "500": "Internal sever Error",
                              "405": "Method Unsupported",
@@ -200,19 +442,31 @@ class HTTPRequestProcessor:
                              "404": "Resource Not Fund",
                              }
         self.rootdir = rootdir
+        # StaticFileCache shared between connections or None
+        self.file_cache = file_cache
         # Date, Server, Content‐Length, Content‐Type, Connection
         self.headers = dict(Server='OTUServer')
         self.version = "HTTP/1.1"
         self.supported_methods = ["GET", "HEAD"]
         self.uri_pattern = re.compile(r"^\/[\/\.a-zA-Z0-9\-\_\%]*$")
+        # whether connection stays open after the current response
+        self.keep_alive = False
+        # GET body not included in the response bytes, sent by the caller with os.sendfile
+        self.response_file = None
+        self.response_file_size = 0
+        self.use_sendfile = hasattr(os, "sendfile")
 
     def create_response_for_message(self, request):
+        self.keep_alive = False
         try:
             processed_str = request.decode("utf-8")
         except UnicodeDecodeError:
             return self.create_response_not_200("500")
         method, uri, *_ = processed_str.split(" ")
+        self.keep_alive = self.wants_keep_alive(processed_str)
         if method not in self.supported_methods:
+            # request body is not read, so the connection can't be reused
+            self.keep_alive = False
             return self.create_response_not_200("405")
         if method.upper() == "GET":
             response = self.validate_uri(method, uri)
@@ -220,31 +474,82 @@ class HTTPRequestProcessor:
             response = self.validate_uri(method, uri)
         return response
 
+    @staticmethod
+    def wants_keep_alive(processed_str):
+        # HTTP/1.1 keeps connection unless "Connection: close", HTTP/1.0 only with "Connection: keep-alive",
+        # requests with body are not kept
+        request_line, *header_lines = processed_str.split("\r\n")
+        headers = {}
+        for header_line in header_lines:
+            name, _, value = header_line.partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+        if headers.get("content-length", "0") != "0" or "transfer-encoding" in headers:
+            return False
+        connection = headers.get("connection", "")
+        if "close" in connection:
+            return False
+        return request_line.endswith("HTTP/1.1") or "keep-alive" in connection
+
     def create_response_not_200(self, responsecode):
         self._flush_headers()
-        send_mesg = self._format_response_head(responsecode)
+        # error happened after the body file was opened
+        response_file, _ = self.pop_response_file()
+        if response_file is not None:
+            response_file.close()
         with open(f"error_templates/{responsecode}.html", 'rb') as error_file:
             body = error_file.read()
+        # headers go before the head is formatted, keep-alive clients need Content-Length
         self.headers['Content-Length'] = self.get_file_size(f"error_templates/{responsecode}.html")
-        self.headers['Content‐Type'] = mimetypes.guess_type(f"error_templates/{responsecode}.html")[0]
-        self.headers['Connection'] = "close"
+        self.headers['Content-Type'] = mimetypes.guess_type(f"error_templates/{responsecode}.html")[0]
+        self.headers['Connection'] = self.connection_header()
+        send_mesg = self._format_response_head(responsecode)
         response = send_mesg.encode("utf-8") + body
-        logging.debug(f"Sended message {response}")
+        logging.debug("Sended message %s", send_mesg)
         return response
 
     def create_response_200(self, method, uri="error_templates/404.html"):
-        # self._flush_headers()
+        self._flush_headers()
         body = b""
-        self.headers['Content-Length'] = self.get_file_size(uri)
-        self.headers["Content-Type"] = mimetypes.guess_type(uri)[0]
-        self.headers['Connection'] = "close"
         if method == "GET":
-            with open(uri, "rb") as error_file:
-                body = error_file.read()
+            body_file = open(uri, "rb")
+            # size of opened file, it is what will be sent
+            size = os.fstat(body_file.fileno()).st_size
+            if self.use_sendfile and size >= SENDFILE_MIN_SIZE:
+                self.response_file, self.response_file_size = body_file, size
+            else:
+                with body_file:
+                    body = body_file.read()
+                size = len(body)
+        else:
+            size = self.get_file_size(uri)
+        self.headers['Content-Length'] = size
+        self.headers["Content-Type"] = mimetypes.guess_type(uri)[0]
+        self.headers['Connection'] = self.connection_header()
         send_mesg = self._format_response_head("200")
-        response = send_mesg.encode("utf-8") + body
-        logging.debug(f"Sended message {response}")
-        return response
+        logging.debug("Sended message %s", send_mesg)
+        return send_mesg.encode("utf-8") + body
+
+    def create_cached_response_200(self, method, cached):
+        head = (f'{cached.head_block}Connection: {self.connection_header()}\r\n'
+                f'Date: {self._create_timestamp()}\r\n\r\n').encode("utf-8")
+        logging.debug("Sended message %s", head)
+        if method == "GET":
+            return head + cached.body
+        return head
+
+    def format_head_block(self, size, content_type):
+        # status line and headers of 200 response before Connection and Date, same order as _create_headers
+        self._flush_headers()
+        self.headers['Content-Length'] = size
+        self.headers['Content-Type'] = content_type
+        head_block = f'{self.version} 200 {self.responsecode["200"]}\r\n'
+        return head_block + ''.join(f'{key}: {value}\r\n' for key, value in self.headers.items())
+
+    def pop_response_file(self):
+        # open file with the body of the last response and its size, (None, 0) if body is in response bytes
+        response_file, size = self.response_file, self.response_file_size
+        self.response_file, self.response_file_size = None, 0
+        return response_file, size
 
     def validate_uri(self, method, uri):
         try:
@@ -257,6 +562,10 @@ class HTTPRequestProcessor:
             # understand spaces и %XX in filename
             uri = self.unquote_uri(uri)
             uri = os.path.join(self.rootdir, uri.lstrip('/'))
+            if self.file_cache is not None:
+                cached = self.file_cache.get(uri, self.format_head_block)
+                if cached is not None:
+                    return self.create_cached_response_200(method, cached)
             if os.path.isdir(uri):
                 uri = os.path.join(uri, 'index.html')
             if not os.path.isfile(uri):
@@ -287,6 +596,9 @@ class HTTPRequestProcessor:
     def _create_timestamp():
         return datetime.datetime.strftime(datetime.datetime.now(), "%d %b %Y %H:%M")
 
+    def connection_header(self):
+        return "keep-alive" if self.keep_alive else "close"
+
     def _flush_headers(self):
         self.headers = dict(Server='OTUServer')
 
@@ -297,6 +609,8 @@ class HTTPRequestProcessor:
     @staticmethod
     def unquote_uri(uri):
         # from urllib.parse lightly changed
+        if "%" not in uri:
+            return uri
         _hexdig = '0123456789ABCDEFabcdef'
         _hextobyte = None
         if _hextobyte is None:
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import selectors
+import socket
+import tempfile
+import time
+import unittest
+import lib_for_http_server as lib_helper
+
+
+def format_head_block(size, content_type):
+    return f'{size} {content_type}\r\n'
+
+
+def read_responses(data):
+    # (status line, headers, body) of every complete response in data
+    responses = []
+    while b'\r\n\r\n' in data:
+        head, _, data = data.partition(b'\r\n\r\n')
+        status_line, *header_lines = head.decode().split('\r\n')
+        headers = dict(line.split(': ', 1) for line in header_lines)
+        size = int(headers['Content-Length'])
+        if len(data) < size:
+            break
+        responses.append((status_line, headers, data[:size]))
+        data = data[size:]
+    return responses
+
+
+class StaticFileCacheTests(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+
+    def write(self, name, body):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file_item:
+            file_item.write(body)
+        return path
+
+    def test_least_recently_used_file_is_evicted(self):
+        cache = lib_helper.StaticFileCache(100, max_file_size=60)
+        paths = [self.write(name, b'x' * 40) for name in ('a.html', 'b.html', 'c.html')]
+        cache.get(paths[0], format_head_block)
+        cache.get(paths[1], format_head_block)
+        # a.html is used again, so b.html is the oldest one
+        cache.get(paths[0], format_head_block)
+        cache.get(paths[2], format_head_block)
+        self.assertEqual(list(cache.files), [paths[0], paths[2]])
+        self.assertEqual(cache.size, 80)
+
+    def test_changed_file_is_reloaded(self):
+        cache = lib_helper.StaticFileCache(1024)
+        path = self.write('page.html', b'first')
+        cached = cache.get(path, format_head_block)
+        self.assertEqual((cached.body, cached.content_type, cached.head_block),
+                         (b'first', 'text/html', '5 text/html\r\n'))
+        self.assertIs(cache.get(path, format_head_block), cached)
+        # same size, only mtime tells the file is new
+        self.write('page.html', b'again')
+        os.utime(path, ns=(cached.mtime_ns + 10 ** 9, cached.mtime_ns + 10 ** 9))
+        self.assertEqual(cache.get(path, format_head_block).body, b'again')
+        # new inode
+        os.replace(self.write('new.html', b'third'), path)
+        self.assertEqual(cache.get(path, format_head_block).body, b'third')
+        self.write('page.html', b'longer body')
+        self.assertEqual(cache.get(path, format_head_block).body, b'longer body')
+        self.assertEqual(cache.size, len(b'longer body'))
+
+    def test_large_files_are_not_cached(self):
+        cache = lib_helper.StaticFileCache(1024 * 1024)
+        path = self.write('large.js', b'x' * lib_helper.SENDFILE_MIN_SIZE)
+        self.assertIsNone(cache.get(path, format_head_block))
+        small_path = self.write('small.js', b'x' * (lib_helper.SENDFILE_MIN_SIZE - 1))
+        self.assertEqual(cache.get(small_path, format_head_block).size, lib_helper.SENDFILE_MIN_SIZE - 1)
+        # file grew between stat and read
+        cache = lib_helper.StaticFileCache(100, max_file_size=10)
+        self.assertIsNone(cache._load(self.write('grown.html', b'x' * 20), format_head_block))
+        self.assertEqual((list(cache.files), cache.size), ([], 0))
+
+    def test_directory_is_served_by_index(self):
+        cache = lib_helper.StaticFileCache(1024)
+        index_path = self.write(os.path.join('dir', 'index.html'), b'index')
+        cached = cache.get(os.path.join(self.root, 'dir'), format_head_block)
+        self.assertEqual((cached.path, cached.body), (index_path, b'index'))
+        self.assertIsNone(cache.get(os.path.join(self.root, 'empty'), format_head_block))
+        os.makedirs(os.path.join(self.root, 'no_index'))
+        self.assertIsNone(cache.get(os.path.join(self.root, 'no_index'), format_head_block))
+
+
+async def read_responses_from(reader, count):
+    data = b''
+    while len(read_responses(data)) < count:
+        chunk = await reader.read(65536)
+        if not chunk:
+            break
+        data += chunk
+    return read_responses(data)
+
+
+class SendfileRecordingProtocol(lib_helper.HTTPProtocol):
+    # sizes of bodies sent with loop.sendfile
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent_files = []
+
+    async def send_file(self, response_file, size):
+        self.sent_files.append(size)
+        await super().send_file(response_file, size)
+
+
+class KeepAliveTests(unittest.TestCase):
+    def test_wants_keep_alive(self):
+        wants_keep_alive = lib_helper.HTTPRequestProcessor.wants_keep_alive
+        self.assertTrue(wants_keep_alive('GET / HTTP/1.1\r\nHost: localhost'))
+        self.assertFalse(wants_keep_alive('GET / HTTP/1.1\r\nConnection: close'))
+        self.assertFalse(wants_keep_alive('GET / HTTP/1.0\r\nHost: localhost'))
+        self.assertTrue(wants_keep_alive('GET / HTTP/1.0\r\nConnection: Keep-Alive'))
+        # body is not read, it would be taken for the next request
+        self.assertFalse(wants_keep_alive('POST / HTTP/1.1\r\nContent-Length: 5'))
+        self.assertFalse(wants_keep_alive('POST / HTTP/1.1\r\nTransfer-Encoding: chunked'))
+        self.assertTrue(wants_keep_alive('GET / HTTP/1.1\r\nContent-Length: 0'))
+
+
+class MessageTests(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        for name in ('a.html', 'b.html', 'c.html'):
+            with open(os.path.join(tmp_dir.name, name), 'wb') as file_item:
+                file_item.write(name.encode())
+        self.sel = selectors.DefaultSelector()
+        self.addCleanup(self.sel.close)
+        server_sock, self.client = socket.socketpair()
+        self.addCleanup(self.client.close)
+        server_sock.setblocking(False)
+        self.client.setblocking(False)
+        self.message = lib_helper.Message(self.sel, server_sock, 'test', tmp_dir.name)
+        self.sel.register(server_sock, selectors.EVENT_READ, data=self.message)
+        self.addCleanup(lambda: self.message.sock and self.message.close())
+
+    def serve(self, count):
+        # run the selector loop until count responses came to the client or the connection is closed
+        data = b''
+        deadline = time.monotonic() + 5
+        while len(read_responses(data)) < count and time.monotonic() < deadline:
+            for key, mask in self.sel.select(timeout=0.1):
+                key.data.process_events(mask)
+            try:
+                chunk = self.client.recv(65536)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                break
+            data += chunk
+        return read_responses(data)
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        self.client.sendall(b''.join(f'GET /{name} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode()
+                                     for name in ('c.html', 'a.html', 'b.html')))
+        responses = self.serve(3)
+        self.assertEqual([body for _, _, body in responses], [b'c.html', b'a.html', b'b.html'])
+        self.assertEqual({headers['Connection'] for _, headers, _ in responses}, {'keep-alive'})
+        self.assertIsNotNone(self.message.sock)
+        self.assertIsNone(self.message.request)
+
+    def test_connection_is_closed_after_close_request(self):
+        self.client.sendall(b'GET /a.html HTTP/1.1\r\n\r\n'
+                            b'GET /b.html HTTP/1.1\r\nConnection: close\r\n\r\n'
+                            b'GET /c.html HTTP/1.1\r\n\r\n')
+        responses = self.serve(3)
+        self.assertEqual([(body, headers['Connection']) for _, headers, body in responses],
+                         [(b'a.html', 'keep-alive'), (b'b.html', 'close')])
+        self.assertIsNone(self.message.sock)
+        self.assertEqual(self.client.recv(1024), b'')
+
+    def test_idle_connection(self):
+        self.assertFalse(self.message.is_idle(time.monotonic(), 5))
+        self.assertTrue(self.message.is_idle(self.message.last_activity + 6, 5))
+        self.client.sendall(b'GET /a.html HTTP/1.1\r\n\r\n')
+        self.message.read()
+        # request in progress is not idle
+        self.assertFalse(self.message.is_idle(self.message.last_activity + 6, 5))
+        self.assertEqual(len(self.serve(1)), 1)
+        self.assertTrue(self.message.is_idle(self.message.last_activity + 6, 5))
+
+
+class HTTPProtocolTests(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        for name in ('a.html', 'b.html', 'c.html'):
+            with open(os.path.join(self.root, name), 'wb') as file_item:
+                file_item.write(name.encode())
+        self.large_body = bytes(range(256)) * (lib_helper.SENDFILE_MIN_SIZE // 256)
+        with open(os.path.join(self.root, 'large.bin'), 'wb') as file_item:
+            file_item.write(self.large_body)
+        self.protocols = []
+
+    def protocol_factory(self, keepalive_timeout):
+        protocol = SendfileRecordingProtocol(self.root, keepalive_timeout=keepalive_timeout)
+        self.protocols.append(protocol)
+        return protocol
+
+    def run_client(self, client, keepalive_timeout=5):
+        # real loop and server on a free port, client(reader, writer) talks to it
+        async def serve():
+            loop = asyncio.get_running_loop()
+            server = await loop.create_server(lambda: self.protocol_factory(keepalive_timeout), '127.0.0.1', 0)
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+                try:
+                    return await asyncio.wait_for(client(reader, writer), 5)
+                finally:
+                    writer.close()
+            finally:
+                server.close()
+        return asyncio.run(serve())
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        async def client(reader, writer):
+            writer.write(b''.join(f'GET /{name} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode()
+                                  for name in ('c.html', 'a.html', 'b.html')))
+            return await read_responses_from(reader, 3)
+
+        responses = self.run_client(client)
+        self.assertEqual([body for _, _, body in responses], [b'c.html', b'a.html', b'b.html'])
+        self.assertEqual({headers['Connection'] for _, headers, _ in responses}, {'keep-alive'})
+
+    def test_connection_is_closed_after_close_request(self):
+        async def client(reader, writer):
+            writer.write(b'GET /a.html HTTP/1.1\r\n\r\n'
+                         b'GET /b.html HTTP/1.1\r\nConnection: close\r\n\r\n'
+                         b'GET /c.html HTTP/1.1\r\n\r\n')
+            # everything up to the close by server
+            return await reader.read()
+
+        data = self.run_client(client)
+        self.assertEqual([(body, headers['Connection']) for _, headers, body in read_responses(data)],
+                         [(b'a.html', 'keep-alive'), (b'b.html', 'close')])
+        self.assertTrue(data.endswith(b'b.html'))
+        # request after close is not processed
+        self.assertEqual(bytes(self.protocols[0].buffer), b'GET /c.html HTTP/1.1\r\n\r\n')
+
+    def test_sendfile_response_before_pipelined_request(self):
+        async def client(reader, writer):
+            writer.write(b'GET /large.bin HTTP/1.1\r\n\r\nGET /a.html HTTP/1.1\r\n\r\n')
+            return await read_responses_from(reader, 2)
+
+        responses = self.run_client(client)
+        self.assertEqual([body for _, _, body in responses], [self.large_body, b'a.html'])
+        self.assertEqual(self.protocols[0].sent_files, [len(self.large_body)])
+
+    def test_idle_connection_is_closed(self):
+        async def client(reader, writer):
+            writer.write(b'GET /a.html HTTP/1.1\r\n\r\n')
+            responses = await read_responses_from(reader, 1)
+            started = time.monotonic()
+            return responses, await reader.read(), time.monotonic() - started
+
+        responses, rest, idle = self.run_client(client, keepalive_timeout=0.3)
+        self.assertEqual((len(responses), rest), (1, b''))
+        self.assertGreater(idle, 0.2)
+        self.assertLess(idle, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
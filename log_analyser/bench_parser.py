@@ -0,0 +1,45 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8; -*-
+
+import argparse
+import time
+import log_analyzer
+
+
+def old_parse(line):
+    try:
+        return log_analyzer.nginx_log_parser(line.decode('utf-8')), None
+    except RuntimeWarning as err:
+        return None, err
+
+
+def bench(parse, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for line in lines:
+            parse(line)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None or elapsed < best else best
+    return len(lines) / best
+
+
+def main(logfile_path, copies, repeat):
+    with open(logfile_path, 'rb') as log_file:
+        lines = log_file.readlines() * copies
+    before = bench(old_parse, lines, repeat)
+    after = bench(log_analyzer.line_parser.parse, lines, repeat)
+    print("lines: %d" % len(lines))
+    print("nginx_log_parser:       %12.0f lines/sec" % before)
+    print("NginxLineParser.parse:  %12.0f lines/sec" % after)
+    print("speedup:                %12.1fx" % (after / before))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", help="nginx log file with sample lines",
+                        default="./test_log_files/nginx-access-ui.log-20180801.log")
+    parser.add_argument("--copies", help="how many times to repeat sample lines", type=int, default=1000)
+    parser.add_argument("--repeat", help="take best of N runs", type=int, default=3)
+    args = parser.parse_args()
+    main(args.log, args.copies, args.repeat)
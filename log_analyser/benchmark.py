@@ -0,0 +1,140 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8; -*-
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import log_analyzer
+
+
+LINE_TEMPLATE = '{ip} -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" ' \
+                '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" ' \
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" {time:.3f}\n'
+URL_TEMPLATES = ['/api/v2/banner/{id}', '/api/v2/group/{id}/banners',
+                 '/api/1/photogenic_banners/list/?server_name={id}',
+                 '/api/v2/internal/html5/phantomjs/queue/?wait={id}', '/export/appinstall_raw/2017-06-{id}/']
+
+
+def generate_log(directory, date, lines, urls, error_ratio=0.0, gz=False, seed=0):
+    # reproducible synthetic nginx-access-ui log, returns its path
+    rnd = random.Random(seed)
+    url_pool = [rnd.choice(URL_TEMPLATES).format(id=rnd.randrange(10 ** 8)) for _ in range(urls)]
+    path = os.path.join(directory, 'nginx-access-ui.log-%s.%s' % (date, 'gz' if gz else 'log'))
+    fopen = gzip.open if gz else open
+    with fopen(path, 'wt') as log_file:
+        for _ in range(lines):
+            if rnd.random() < error_ratio:
+                log_file.write('broken line %d\n' % rnd.randrange(10 ** 6))
+                continue
+            # few urls get most of the requests, like in real logs
+            url = url_pool[min(int(rnd.expovariate(10.0 / urls)), urls - 1)]
+            log_file.write(LINE_TEMPLATE.format(ip='1.%d.%d.%d' % (rnd.randrange(256), rnd.randrange(256),
+                                                                   rnd.randrange(256)),
+                                                url=url, time=rnd.lognormvariate(-2, 1)))
+    return path
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def timed(results, stage, func, lines=None):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    results[stage] = {'seconds': round(elapsed, 6),
+                      'lines_per_sec': round(lines / elapsed, 1) if lines and elapsed else None,
+                      'peak_rss_kb': peak_rss_kb()}
+    return result
+
+
+def state_kb(logfile, options):
+    # memory held by per-url statistics after streaming the log once more under tracemalloc
+    tracemalloc.start()
+    state = log_analyzer.count_statistics(log_analyzer.process_lines_in_file(logfile), options)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del state
+    return size // 1024
+
+
+def run(directory, lines, urls, error_ratio, gz, seed, report_size, template, options):
+    results = {}
+    generate_log(directory, '20170629', lines, urls, error_ratio, gz, seed)
+    logfile = timed(results, 'catchfile', lambda: log_analyzer.catchfile(directory))
+    parsed = timed(results, 'process_lines_in_file',
+                   lambda: list(log_analyzer.process_lines_in_file(logfile)), lines)
+    fopen = gzip.open if gz else open
+    with fopen(logfile.path, 'rb') as log_file:
+        sample = [line.decode('utf-8') for _, line in zip(range(min(lines, 100000)), log_file)]
+
+    def old_parser():
+        for line in sample:
+            try:
+                log_analyzer.nginx_log_parser(line)
+            except RuntimeWarning:
+                pass
+
+    timed(results, 'nginx_log_parser', old_parser, len(sample))
+    state = timed(results, 'aggregation', lambda: log_analyzer.count_statistics(parsed, options), lines)
+    results['aggregation']['state_kb'] = state_kb(logfile, options)
+    parsed = None
+    rows = timed(results, 'finalize_statistics',
+                 lambda: log_analyzer.finalize_statistics(state, 1.0, report_size))
+    timed(results, 'json_render',
+          lambda: log_analyzer.json_render(log_analyzer.format_and_sort_to_json(rows, report_size), template))
+
+    def render_to_file():
+        with open(os.path.join(directory, 'report.html'), 'w', encoding='utf-8') as report_file:
+            log_analyzer.json_render_to_file(log_analyzer.select_top_rows(rows, report_size), template, report_file)
+
+    timed(results, 'json_render_to_file', render_to_file)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="log_analyzer benchmark on synthetic nginx logs")
+    parser.add_argument("--lines", type=int, default=1000000, help="lines in generated log")
+    parser.add_argument("--urls", type=int, default=10000, help="distinct urls in generated log")
+    parser.add_argument("--error-ratio", type=float, default=0.01, help="share of broken lines")
+    parser.add_argument("--gz", action="store_true", help="generate gzipped log")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of generator")
+    parser.add_argument("--report-size", type=int, default=1000, help="REPORT_SIZE")
+    parser.add_argument("--template", default="./templates/report.html", help="REPORT_TEMPLATE")
+    parser.add_argument("--dir", default=None, help="directory for generated log, kept after run")
+    parser.add_argument("--output", default=None, help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix='log_analyzer_bench_')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        stages = run(directory, args.lines, args.urls, args.error_ratio, args.gz, args.seed,
+                     args.report_size, args.template, log_analyzer.DEFAULT_COUNT_OPTIONS)
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
+    result = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'params': {'lines': args.lines, 'urls': args.urls, 'error_ratio': args.error_ratio,
+                         'gz': args.gz, 'seed': args.seed, 'report_size': args.report_size},
+              'stages': stages}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
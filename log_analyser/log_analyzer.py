@@ -1,18 +1,350 @@
 #!/usr/local/bin/python3
 # -*- coding: utf-8; -*-
 
+import cProfile
+import functools
 import gzip
 import datetime
+import math
+import mmap
+import pickle
 import os
 import re
+import struct
+import sys
+from array import array
 from collections import namedtuple
+from operator import attrgetter, itemgetter
 import json
 import argparse
+import heapq
 import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import time
+import tracemalloc
+from contextlib import contextmanager
 from statistics import median
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 
 Logfile: namedtuple = namedtuple('Logfile', 'path date ext')
+# sketch_error - keep times in QuantileSketch instead of array of times,
+# url_normalizer - UrlNormalizer applied to every url,
+# max_urls - count only this number of urls with the biggest time_sum (0 - all),
+# needs sketch_error: evicted url gives its times to the new one, memory is bounded only by sketch
+CountOptions: namedtuple = namedtuple('CountOptions', 'sketch_error url_normalizer max_urls',
+                                      defaults=(None, None, 0))
+DEFAULT_COUNT_OPTIONS = CountOptions()
+
+
+def options_key(options):
+    # comparable and picklable description of options for checkpoints
+    sketch_error, url_normalizer, max_urls = options or DEFAULT_COUNT_OPTIONS
+    return sketch_error, url_normalizer.rules if url_normalizer else None, max_urls
+
+
+class QuantileSketch:
+    # Mergeable quantile sketch with relative error guarantee (DDSketch style).
+    # Values are counted in logarithmic buckets, so memory depends on the range
+    # of response times and relative_error, not on the number of requests.
+    # Sum of values is kept exact as non-overlapping partials (math.fsum algorithm),
+    # so it doesn't depend on the order of adds and merges.
+    def __init__(self, relative_error=0.01, max_buckets=2048, min_value=1e-6):
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.min_value = min_value
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.partials = []
+
+    def add(self, value):
+        self.count += 1
+        self._add_to_total(value)
+        if value <= self.min_value:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Can't merge sketches with different relative error")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for partial in other.partials:
+            self._add_to_total(partial)
+        for index, bucket_count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + bucket_count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+        return self
+
+    def _add_to_total(self, value):
+        partials = self.partials
+        i = 0
+        for partial in partials:
+            if abs(value) < abs(partial):
+                value, partial = partial, value
+            high = value + partial
+            low = partial - (high - value)
+            if low:
+                partials[i] = low
+                i += 1
+            value = high
+        partials[i:] = [value]
+
+    def total(self):
+        return math.fsum(self.partials)
+
+    def _collapse(self):
+        # join lowest buckets, high quantiles keep their accuracy
+        indexes = sorted(self.buckets)
+        collapsed = indexes[:len(indexes) - self.max_buckets + 1]
+        self.buckets[collapsed[-1]] = sum(self.buckets.pop(index) for index in collapsed)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 0.0
+
+
+class UrlNormalizer:
+    # Rewrites raw urls before counting, so /api/v2/banner/25019354 and
+    # /api/v2/banner/16852664 are counted as one url. Rule is a name of
+    # builtin rule or [regex, replacement] pair, rules are applied in order.
+    builtin_rules = {
+        "strip_query": (r"\?.*$", ""),
+        "collapse_ids": (r"/\d+(?=/|$)", "/{id}"),
+    }
+
+    def __init__(self, rules):
+        self.rules = tuple(self.builtin_rules[rule] if isinstance(rule, str) else tuple(rule)
+                           for rule in rules)
+        self.patterns = [(re.compile(pattern.encode()), replacement.encode())
+                         for pattern, replacement in self.rules]
+
+    def __call__(self, request_url):
+        for pattern, replacement in self.patterns:
+            request_url = pattern.sub(replacement, request_url)
+        return request_url
+
+
+class ErrorBudgetMonitor:
+    # Stops parsing early when share of errors is surely above error_ratio.
+    # Checks are made after sample_lines, 2 * sample_lines, 4 * sample_lines ...
+    # lines, k-th check uses Hoeffding bound with confidence delta / 2 ** k,
+    # so a good file is rejected with probability below delta over all checks.
+    def __init__(self, error_ratio, sample_lines=10000, delta=0.001):
+        self.error_ratio = error_ratio
+        self.sample_lines = sample_lines
+        self.delta = delta
+        self.next_check = sample_lines
+        self.checks = 0
+
+    def check(self, line_counter, err_counter):
+        if not self.sample_lines or line_counter < self.next_check:
+            return
+        while self.next_check <= line_counter:
+            self.next_check *= 2
+        self.checks += 1
+        bound = math.sqrt(math.log(2 ** self.checks / self.delta) / (2 * line_counter))
+        if err_counter / line_counter - bound > self.error_ratio:
+            logging.info("Stop parsing after %d lines, %d errors" % (line_counter, err_counter))
+            raise_wrong_format(line_counter - err_counter, line_counter, self.error_ratio)
+
+    def check_sample(self, parsed_lines):
+        # check first sample_lines of parsed lines before they are counted elsewhere
+        line_counter = err_counter = 0
+        for parsed in islice(parsed_lines, self.sample_lines):
+            line_counter += 1
+            if parsed is PARSE_ERROR:
+                err_counter += 1
+        self.check(line_counter, err_counter)
+
+
+class ProgressMetrics:
+    # Progress of the current file for the metrics endpoint. Counting code
+    # stores here the same state tuple it fills, the endpoint only reads it.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.started = None
+        self.state = None
+        self.offset = 0
+        # lines of the state loaded from checkpoint, lines_per_sec is for lines counted now
+        self.started_lines = 0
+        self.files_done = 0
+        self.bytes_done = 0
+
+    def start_file(self, path, offset=0):
+        with self.lock:
+            if self.path is not None:
+                self.files_done += 1
+                self.bytes_done += self.offset
+            self.path = path
+            self.started = time.time()
+            self.state = None
+            self.offset = offset
+            self.started_lines = 0
+
+    def resume(self, state, offset):
+        # counting goes on from checkpoint state
+        with self.lock:
+            self.state = state
+            self.offset = offset
+            self.started_lines = state[1] if state else 0
+
+    def update(self, state, offset):
+        self.state = state
+        self.offset = offset
+
+    def snapshot(self, top=10):
+        with self.lock:
+            path, started, state, offset = self.path, self.started, self.state, self.offset
+            started_lines = self.started_lines
+            files_done, bytes_done = self.files_done, self.bytes_done
+        result_dict, line_counter, parsed_counter, err_counter = state or ({}, 0, 0, 0)
+        elapsed = time.time() - started if started else 0.0
+        # list() of dict values is taken at once, while counting goes on in other thread
+        rows = heapq.nlargest(top, list(result_dict.values()), key=attrgetter('time_sum'))
+        return {'path': path,
+                'lines': line_counter,
+                'parsed': parsed_counter,
+                'errors': err_counter,
+                'error_ratio': err_counter / line_counter if line_counter else 0.0,
+                'elapsed': elapsed,
+                'lines_per_sec': (line_counter - started_lines) / elapsed if elapsed else 0.0,
+                'bytes_processed': offset,
+                'files_done': files_done,
+                'total_bytes_processed': bytes_done + offset,
+                'urls': len(result_dict),
+                'top': [{'request_url': row.request_url.decode('utf-8', errors='replace'),
+                         'count': row.count,
+                         'time_sum': row.time_sum} for row in rows]}
+
+
+progress = ProgressMetrics()
+
+
+class StageTimers:
+    # Always-on cheap timers: seconds and calls per stage of the analysis.
+    # decompression is measured in the reader thread and overlaps parsing.
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def as_dict(self):
+        return {name: {'seconds': round(seconds, 6), 'calls': self.calls[name]}
+                for name, seconds in self.seconds.items()}
+
+
+timers = StageTimers()
+
+
+def timed_stage(name):
+    # decorator, the whole call is counted in timers stage name
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timers.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_batches(batches):
+    # batches of process_batches_in_file, reading and parsing of every batch
+    # is counted in "parsing" stage, so counting can be timed apart
+    batches = iter(batches)
+    while True:
+        with timers.stage('parsing'):
+            try:
+                parsed_lines, end = next(batches)
+            except StopIteration:
+                return
+            parsed_lines = list(parsed_lines)
+        yield parsed_lines, end
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    # GET /metrics?top=N returns progress.snapshot(N) as JSON
+    def do_GET(self):
+        request = urlparse(self.path)
+        if request.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            top = int(parse_qs(request.query).get('top', ['10'])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        body = json.dumps(progress.snapshot(top)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics %s - %s" % (self.address_string(), format % args))
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    # serves in a daemon thread, so it doesn't keep the analyzer running
+    server = MetricsServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Metrics at http://%s:%d/metrics" % server.server_address[:2])
+    return server
+
+
+def raise_wrong_format(parsed_counter, line_counter, error_ratio):
+    logging.info('Wrong format. %d of %d lines parsed. '
+                 'More than %d%% of errors - failed parsing',
+                 parsed_counter, line_counter,
+                 int(error_ratio * 100))
+    raise RuntimeError('Wrong format, '
+                       '%d of %d lines parsed. '
+                       ', More than %d%% of errors - failed parsing' % (parsed_counter,
+                                                                        line_counter,
+                                                                        int(error_ratio * 100)))
 
 
 def init_config(config_filename=None):
@@ -21,8 +353,25 @@ def init_config(config_filename=None):
         "LOG_DIR": "./log",
         "REPORT_DIR": "./reports",
         "REPORT_SIZE": 1000,
+        "PARSE_WORKERS": 1,
+        "QUANTILE_SKETCH": False,
+        "QUANTILE_SKETCH_ERROR": 0.01,
+        "CHECKPOINT_LINES": 0,
+        "REPORT_DAYS": 1,
+        "URL_NORMALIZE": [],
+        "MAX_URLS": 0,
         "REPORT_TEMPLATE": "./templates/report.html",
         "PARSE_ERROR_PERC_MAX": 0.1,
+        "PARSE_ERROR_SAMPLE_LINES": 10000,
+        "LOG_INDEX": "",
+        "WATCH": False,
+        "WATCH_INTERVAL": 60,
+        "METRICS_PORT": 0,
+        "METRICS_HOST": "127.0.0.1",
+        "REPORT_EXPORT": False,
+        "PROFILE": False,
+        "TRACEMALLOC": False,
+        "LOG_FORMATS": {},
         "DEBUG": False
     }
     if config_filename:
@@ -42,45 +391,118 @@ def init_config(config_filename=None):
     return initial_config
 
 
-def catchfile(directory):
-    latest_file = None
-    regexline = r"^(?:nginx-access-ui).*?(?P<log_time>\d{8})\.(?P<ext>log|gz)$"
-    regex = re.compile(regexline)
-    # check directory
-    if not os.path.isdir(directory):
-        raise RuntimeError("Wrong directory name %s" % directory)
-    files = os.listdir(directory)
-    if not files:
-        logging.debug("Could not find a logfile in empty directory %s" % directory)
-        return
-    for file in files:
-        path = os.path.join(directory, file)
-        if not os.path.isfile(path):
-            continue
-        match = regex.match(file)
-        if not match:
-            continue
-        candidate_file = Logfile(path, match.group('log_time'), match.group('ext'))
+LOGFILE_PATTERN = re.compile(r"^(?:nginx-access-ui).*?(?P<log_time>\d{8})\.(?P<ext>log|gz)$")
+
+
+class LogDirIndex:
+    # Index of dated logs in a directory: {file name: (date, ext, size, mtime)}.
+    # Directory is listed by scandir on every refresh, but only new names are
+    # matched, validated and stat'ed, known names are taken from the index.
+    # With index_path the index is kept on disk between runs.
+    def __init__(self, directory, index_path=None, file_pattern=LOGFILE_PATTERN):
+        self.directory = directory
+        self.index_path = index_path
+        self.file_pattern = file_pattern
+        self.entries = self.load()
+
+    def load(self):
+        if not self.index_path or not os.path.isfile(self.index_path):
+            return {}
         try:
-            if not latest_file or str_to_datetime(candidate_file.date) > str_to_datetime(latest_file.date):
-                latest_file = candidate_file
-            else:
-                continue
-        except ValueError:
-            continue
+            with open(self.index_path, 'rb') as index_file:
+                index = pickle.load(index_file)
+        except Exception as err_index:
+            logging.info("Could not load log index %s: %s" % (self.index_path, err_index))
+            return {}
+        if index.get('directory') != os.path.abspath(self.directory) \
+                or index.get('file_pattern') != self.file_pattern.pattern:
+            return {}
+        return index['entries']
+
+    def save(self):
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            pickle.dump({'directory': os.path.abspath(self.directory), 'file_pattern': self.file_pattern.pattern,
+                         'entries': self.entries},
+                        index_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    @timed_stage('discovery')
+    def refresh(self):
+        if not os.path.isdir(self.directory):
+            raise RuntimeError("Wrong directory name %s" % self.directory)
+        entries = {}
+        new_entries = 0
+        with os.scandir(self.directory) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name in self.entries:
+                    entries[dir_entry.name] = self.entries[dir_entry.name]
+                    continue
+                match = self.file_pattern.match(dir_entry.name)
+                if not match or not dir_entry.is_file():
+                    continue
+                try:
+                    str_to_datetime(match.group('log_time'))
+                except ValueError:
+                    continue
+                stat = dir_entry.stat()
+                entries[dir_entry.name] = (match.group('log_time'), match.group('ext'),
+                                           stat.st_size, stat.st_mtime)
+                new_entries += 1
+        changed = new_entries or len(entries) != len(self.entries)
+        self.entries = entries
+        if changed and self.index_path:
+            self.save()
+        logging.debug("Indexed %d logs in %s, %d new" % (len(entries), self.directory, new_entries))
+        return self
+
+    def logfiles(self):
+        # one file per date (first by name), sorted by date
+        files_by_date = {}
+        for name in sorted(self.entries):
+            date, ext = self.entries[name][:2]
+            if date not in files_by_date:
+                files_by_date[date] = Logfile(os.path.join(self.directory, name), date, ext)
+        return [files_by_date[date] for date in sorted(files_by_date)]
+
+    def latest(self):
+        logfiles = self.logfiles()
+        return logfiles[-1] if logfiles else None
+
+    def in_range(self, date_from, date_to):
+        # all logs with date_from <= date <= date_to, dates are compared as YYYYMMDD strings
+        first, last = date_from.strftime('%Y%m%d'), date_to.strftime('%Y%m%d')
+        return [logfile for logfile in self.logfiles() if first <= logfile.date <= last]
+
+
+def catchfile(directory, index_path=None, file_pattern=LOGFILE_PATTERN):
+    latest_file = LogDirIndex(directory, index_path, file_pattern).refresh().latest()
+    if not latest_file:
+        logging.debug("Could not find a logfile in directory %s" % directory)
+        return
     logging.debug("Found latest file %s" % latest_file.path)
     return latest_file
 
 
+def catch_files_in_range(directory, date_from, date_to, index_path=None, file_pattern=LOGFILE_PATTERN):
+    # all logs with date_from <= date <= date_to, one file per date, sorted by date
+    return LogDirIndex(directory, index_path, file_pattern).refresh().in_range(date_from, date_to)
+
+
 def str_to_datetime(date_str):
     format_str = '%Y%m%d'
     datetime_obj = datetime.datetime.strptime(date_str, format_str)
     return datetime_obj
 
 
+LOG_PATTERN = re.compile(r'^\S+.*?\[\S+\s\S+\]\s+\"\S+\s+(?P<request_url>\S+).*?(?P<response_time>\S+)$')
+
+
 def nginx_log_parser(line):
-    logpats = r'^\S+.*?\[\S+\s\S+\]\s+\"\S+\s+(?P<request_url>\S+).*?(?P<response_time>\S+)$'
-    logpat = re.compile(logpats)
+    logpat = LOG_PATTERN
     log = {}
     match = logpat.match(line.rstrip())
     if match:
@@ -95,41 +517,732 @@ def nginx_log_parser(line):
     return log
 
 
+# returned by NginxLineParser.parse for lines which don't match the format
+PARSE_ERROR = None
+
+
+class NginxLineParser:
+    # Fast parser for raw bytes lines. Regex is compiled once and only
+    # finds request url, response time is the last field of the line.
+    def __init__(self):
+        self.request_pattern = re.compile(rb'\S+.*?\[\S+\s\S+\]\s+"\S+\s+(\S+)')
+        # the same pattern for a whole buffer, matches every line either
+        # with (url, last field) groups or as an error line
+        self.buffer_pattern = re.compile(rb'^(?:\S+.*?\[\S+[^\S\n]\S+\][^\S\n]+"\S+[^\S\n]+(\S+)'
+                                         rb'(?:[^\n]*[^\S\n](\S*))?|[^\n]*)$', re.MULTILINE)
+
+    def parse(self, line):
+        match = self.request_pattern.match(line)
+        if match is None:
+            return PARSE_ERROR
+        try:
+            response_time = float(line[line.rfind(b' ', match.end()) + 1:])
+        except ValueError:
+            response_time = self.parse_last_field(line)
+        return match.group(1), response_time
+
+    def scan(self, buffer, start, end):
+        # parse every line of buffer[start:end] with one regex pass,
+        # lines are not copied out of buffer, only url and response time
+        for match in self.buffer_pattern.finditer(buffer, start, end):
+            request_url, response_time = match.groups()
+            if request_url is None:
+                if match.start() == end:
+                    # empty match after the last newline
+                    break
+                yield PARSE_ERROR
+                continue
+            try:
+                response_time = float(response_time)
+            except (TypeError, ValueError):
+                response_time = self.parse_last_field(buffer[match.start():match.end()])
+            yield request_url, response_time
+
+    @staticmethod
+    def parse_last_field(line):
+        # slow path for trailing spaces and '-' values
+        try:
+            return float(line.rsplit(None, 1)[-1])
+        except ValueError:
+            return 0
+
+
+line_parser = NginxLineParser()
+
+
+# variables of nginx log_format which may have spaces in value: number of
+# whitespace separated tokens, None if it depends on the value
+SPACED_VARIABLES = {'time_local': 2, 'request': None, 'http_user_agent': None, 'http_referer': None,
+                    'http_cookie': None}
+URL_VARIABLES = ('request', 'request_uri', 'uri')
+TIME_VARIABLES = ('request_time', 'upstream_response_time')
+LOG_FORMAT_VARIABLE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+
+def tokenize_log_format(log_format):
+    # nginx log_format string to list of (literal text, variable name after it or None)
+    tokens, position = [], 0
+    for match in LOG_FORMAT_VARIABLE.finditer(log_format):
+        tokens.append((log_format[position:match.start()], match.group(1) or match.group(2)))
+        position = match.end()
+    tokens.append((log_format[position:], None))
+    return tokens
+
+
+def render_log_format(tokens, unknown_tokens, target=None):
+    # sample line with marker values, variables with unknown spaces get unknown_tokens tokens,
+    # target variable is always one token, positions are counted from the part start
+    sample = []
+    for number, (literal, variable) in enumerate(tokens):
+        sample.append(literal)
+        if variable is not None:
+            tokens_count = 1 if number == target else SPACED_VARIABLES.get(variable, 1) or unknown_tokens
+            sample.append(' '.join(['\1%d\1' % number] + ['x'] * (tokens_count - 1)))
+    return ''.join(sample)
+
+
+def locate_log_format_field(sample, marker):
+    # (part of line.split(b'"'), token of part.split() or None for the whole part, prefix, suffix)
+    parts = sample.split('"')
+    for part_number, part in enumerate(parts):
+        if marker not in part:
+            continue
+        if part == marker:
+            return part_number, None, 0, 0
+        for token_number, token in enumerate(part.split()):
+            if marker in token:
+                prefix = token.index(marker)
+                return part_number, token_number, prefix, len(token) - prefix - len(marker)
+
+
+class FieldsLogParser:
+    # Parser compiled from nginx log_format. nginx escapes '"' in values,
+    # so a line is split by '"' and url and time are taken by their position:
+    # the whole quoted part or the n-th whitespace separated token of a part.
+    def __init__(self, parts_count, url_field, url_in_request, time_field):
+        self.parts_count = parts_count
+        self.url_field = url_field
+        self.url_in_request = url_in_request
+        self.time_field = time_field
+
+    @staticmethod
+    def field(parts, field):
+        part, token, prefix, suffix = field
+        value = parts[part]
+        if token is not None:
+            value = value.split()[token]
+        return value[prefix:len(value) - suffix]
+
+    def parse(self, line):
+        parts = line.rstrip(b'\r\n').split(b'"')
+        if len(parts) != self.parts_count:
+            return PARSE_ERROR
+        try:
+            request_url = self.field(parts, self.url_field)
+            if self.url_in_request:
+                request_url = request_url.split()[1]
+            response_time = self.field(parts, self.time_field)
+        except IndexError:
+            return PARSE_ERROR
+        try:
+            return request_url, float(response_time)
+        except ValueError:
+            return request_url, 0
+
+    def scan(self, buffer, start, end):
+        # lines are cut from buffer one by one, a chunk of mmap is not copied as a whole
+        while start < end:
+            line_end = buffer.find(b'\n', start, end)
+            if line_end == -1:
+                line_end = end
+            yield self.parse(buffer[start:line_end])
+            start = line_end + 1
+
+
+class RegexLogParser(FieldsLogParser):
+    # Fallback for formats where positions depend on values: the whole
+    # log_format is compiled to one regex with url and time groups.
+    def __init__(self, tokens, url_variable, time_variable):
+        pattern, quoted, groups = [], False, {url_variable: b'url', time_variable: b'time'}
+        for literal, variable in tokens:
+            pattern.append(re.escape(literal.encode('utf-8')))
+            quoted ^= literal.count('"') % 2 == 1
+            if variable is None:
+                continue
+            tokens_count = SPACED_VARIABLES.get(variable, 1)
+            if quoted:
+                value = rb'[^"]*?'
+            elif tokens_count is None:
+                value = rb'.*?'
+            else:
+                value = rb'\S*' + rb'[^\S\n]+\S*' * (tokens_count - 1)
+            if variable in groups:
+                value = b'(?P<%s>%s)' % (groups.pop(variable), value)
+            pattern.append(value)
+        self.pattern = re.compile(b''.join(pattern) + rb'\s*$')
+        self.url_in_request = url_variable == 'request'
+
+    def parse(self, line):
+        match = self.pattern.match(line.rstrip(b'\r\n'))
+        if match is None:
+            return PARSE_ERROR
+        request_url = match.group('url')
+        if self.url_in_request:
+            request_url = request_url.split()
+            if len(request_url) < 2:
+                return PARSE_ERROR
+            request_url = request_url[1]
+        try:
+            return request_url, float(match.group('time'))
+        except ValueError:
+            return request_url, 0
+
+
+def compile_log_format(log_format):
+    # nginx log_format to parser with parse(line) and scan(buffer, start, end),
+    # positional FieldsLogParser when possible, RegexLogParser otherwise
+    tokens = tokenize_log_format(log_format)
+    variables = [variable for _, variable in tokens if variable is not None]
+    url_variable = next((variable for variable in URL_VARIABLES if variable in variables), None)
+    time_variable = next((variable for variable in TIME_VARIABLES if variable in variables), None)
+    if url_variable is None or time_variable is None:
+        raise ValueError("log_format needs one of %s and one of %s" % (URL_VARIABLES, TIME_VARIABLES))
+    fields = []
+    for variable in (url_variable, time_variable):
+        target = next(number for number, (_, name) in enumerate(tokens) if name == variable)
+        # position must not depend on the number of spaces in values
+        positions = {locate_log_format_field(render_log_format(tokens, unknown_tokens, target), '\1%d\1' % target)
+                     for unknown_tokens in (1, 2)}
+        fields.append(positions.pop() if len(positions) == 1 else None)
+    url_field, time_field = fields
+    if url_field is None or time_field is None or (url_variable == 'request' and url_field[1] is not None):
+        return RegexLogParser(tokens, url_variable, time_variable)
+    parts_count = len(render_log_format(tokens, 1).split('"'))
+    return FieldsLogParser(parts_count, url_field, url_variable == 'request', time_field)
+
+
+# name - report and checkpoint names suffix ('' for the default nginx-access-ui logs),
+# file_pattern - regex of log file names with log_time and ext groups,
+# parser - NginxLineParser or compiled log_format
+LogFormat: namedtuple = namedtuple('LogFormat', 'name file_pattern parser')
+
+
+class LogFormatRegistry:
+    # Log formats by file name pattern, the default format is used
+    # for files which don't match any registered pattern.
+    def __init__(self, default):
+        self.default = default
+        self.formats = {}
+
+    def register(self, name, file_pattern, log_format=None):
+        parser = compile_log_format(log_format) if log_format else line_parser
+        self.formats[name] = LogFormat(name, re.compile(file_pattern), parser)
+        return self.formats[name]
+
+    def for_path(self, path):
+        file_name = os.path.basename(path)
+        for log_format in self.formats.values():
+            if log_format.file_pattern.match(file_name):
+                return log_format
+        return self.default
+
+    def parser_for(self, path):
+        return self.for_path(path).parser
+
+    def __iter__(self):
+        yield self.default
+        yield from self.formats.values()
+
+
+log_formats = LogFormatRegistry(LogFormat('', LOGFILE_PATTERN, line_parser))
+
+
+def register_log_formats(config_formats):
+    # LOG_FORMATS config: {name: {"file_pattern": regex, "log_format": nginx log_format}}
+    for name, config_format in config_formats.items():
+        log_formats.register(name, config_format["file_pattern"], config_format.get("log_format"))
+
+
+READ_BLOCK_SIZE = 1 << 20
+SCAN_BATCH_SIZE = 16 << 20
+
+
 def process_lines_in_file(filecatcher_result_f):
-    fopen = gzip.open if filecatcher_result_f.ext == "gz" else open
-    with fopen(filecatcher_result_f.path, 'rb') as file_item:
-        for line in file_item:
+    for parsed_lines, _ in process_batches_in_file(filecatcher_result_f):
+        yield from parsed_lines
+
+
+def process_batches_in_file(filecatcher_result_f, offset=0):
+    # yield (parsed lines, offset of the byte after them) starting from offset,
+    # offset is None for the last line without newline (it may be not written yet)
+    parser = log_formats.parser_for(filecatcher_result_f.path)
+    if filecatcher_result_f.ext == "gz":
+        # decompression runs in a thread (zlib releases GIL) while lines are parsed
+        with gzip.open(filecatcher_result_f.path, 'rb') as file_item:
+            if offset:
+                file_item.seek(offset)
+            for lines, end in split_blocks_to_lines(read_blocks_in_thread(file_item), offset):
+                yield parse_lines(lines, parser), end
+    else:
+        yield from scan_batches_in_mmap(filecatcher_result_f.path, offset, parser=parser)
+
+
+def scan_batches_in_mmap(path, start=0, batch_size=SCAN_BATCH_SIZE, parser=None):
+    parser = parser or log_formats.parser_for(path)
+    with open(path, 'rb') as file_item:
+        size = os.fstat(file_item.fileno()).st_size
+        if size <= start:
+            return
+        with mmap.mmap(file_item.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            while start < size:
+                batch_end = mapping.find(b'\n', min(start + batch_size, size) - 1)
+                if batch_end == -1:
+                    # complete lines of the tail get their offset, only the unfinished last line has None
+                    complete_end = mapping.rfind(b'\n', start, size) + 1
+                    if complete_end > start:
+                        yield parser.scan(mapping, start, complete_end), complete_end
+                        start = complete_end
+                    yield parser.scan(mapping, start, size), None
+                    break
+                batch_end += 1
+                yield parser.scan(mapping, start, batch_end), batch_end
+                start = batch_end
+
+
+def find_complete_end(path):
+    # offset after the last newline in file
+    with open(path, 'rb') as file_item:
+        if not os.fstat(file_item.fileno()).st_size:
+            return 0
+        with mmap.mmap(file_item.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            return mapping.rfind(b'\n') + 1
+
+
+def scan_lines_in_mmap(path, start=0, end=None, parser=None):
+    # parse plain log file through memory mapping without per line bytes objects
+    parser = parser or log_formats.parser_for(path)
+    with open(path, 'rb') as file_item:
+        size = os.fstat(file_item.fileno()).st_size
+        if not size:
+            return
+        end = size if end is None else min(end, size)
+        with mmap.mmap(file_item.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            yield from parser.scan(mapping, start, end)
+
+
+def read_blocks(file_item, block_size=READ_BLOCK_SIZE):
+    while True:
+        with timers.stage('decompression'):
+            block = file_item.read(block_size)
+        if not block:
+            break
+        yield block
+
+
+def read_blocks_in_thread(file_item, block_size=READ_BLOCK_SIZE, queue_size=4):
+    blocks = queue.Queue(queue_size)
+    stopped = threading.Event()
+
+    def put(item):
+        # False if consumer stopped, it doesn't take items from the full queue any more
+        while not stopped.is_set():
             try:
-                yield (nginx_log_parser(line.decode('utf-8'))), None
-            except RuntimeWarning as err_process_lines_in_file:
-                yield None, err_process_lines_in_file
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
+    def reader():
+        try:
+            for block in read_blocks(file_item, block_size):
+                if not put(block):
+                    return
+            put(None)
+        except Exception as err_read:
+            put(err_read)
 
-def process_and_count_statistics_from_file_lines(filecatcher_result_process, error_ratio=0.2):
-    logging.info("Started process file")
-    line_counter = 0
-    err_counter = 0
-    parsed_counter = 0
-    total_response_time = 0
-    result_dict = {}
-    # form result_dict
-    for line, err_process in process_lines_in_file(filecatcher_result_process):
+    thread = threading.Thread(target=reader, name="block-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        # consumer may stop early, let reader leave before file is closed
+        stopped.set()
+        thread.join()
+
+
+def split_blocks_to_lines(blocks, offset=0):
+    # yield lists of lines (without newline) for every block with offset after them,
+    # the unfinished last line of a block is carried to the next one
+    tail = b''
+    for block in blocks:
+        offset += len(block)
+        lines = block.split(b'\n')
+        if tail:
+            lines[0] = tail + lines[0]
+        tail = lines.pop()
+        yield lines, offset - len(tail)
+    if tail:
+        yield [tail], None
+
+
+def parse_lines(lines, parser=line_parser):
+    return map(parser.parse, lines)
+
+
+def split_file_to_chunks(path, chunks_count, start=0, end=None):
+    # split file range to byte ranges [start, end) aligned on newlines
+    end = os.path.getsize(path) if end is None else end
+    bounds = [start]
+    with open(path, 'rb') as file_item:
+        for chunk_number in range(1, chunks_count):
+            position = start + (end - start) * chunk_number // chunks_count
+            if position <= bounds[-1]:
+                continue
+            file_item.seek(position - 1)
+            file_item.readline()
+            position = file_item.tell()
+            if bounds[-1] < position < end:
+                bounds.append(position)
+    bounds.append(end)
+    return [(chunk_start, chunk_end) for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:])
+            if chunk_start < chunk_end]
+
+
+def count_statistics(parsed_lines, options=None, state=None):
+    # state is (result_dict, line_counter, parsed_counter, err_counter) to continue counting
+    options = options or DEFAULT_COUNT_OPTIONS
+    sketch_error, url_normalizer, max_urls = options
+    if max_urls and not sketch_error:
+        raise ValueError("max_urls needs sketch_error, otherwise all times are kept")
+    result_dict, line_counter, parsed_counter, err_counter = state or ({}, 0, 0, 0)
+    eviction_heap = []
+    for parsed in parsed_lines:
         line_counter += 1
-        if line:
-            parsed_counter += 1
-            statistic_dict = result_dict.get(line['request_url'],
-                                             {'request_url': line['request_url'],
-                                              'count': 0, 'time_sum': 0.0, 'time_max': 0.0, 'time_list': []})
-            statistic_dict['count'] += 1
-            statistic_dict['time_list'].append(line['response_time'])
-            statistic_dict['time_sum'] += line['response_time']
-            statistic_dict['time_max'] = line['response_time'] \
-                if line['response_time'] > statistic_dict['time_max'] else statistic_dict['time_max']
-            total_response_time += line['response_time']
-            result_dict[line['request_url']] = statistic_dict
-        elif err_process:
+        if parsed is PARSE_ERROR:
             err_counter += 1
-            logging.debug(err_process)
+            continue
+        parsed_counter += 1
+        request_url, response_time = parsed
+        if url_normalizer:
+            request_url = url_normalizer(request_url)
+        statistic_dict = result_dict.get(request_url)
+        if statistic_dict is None:
+            if max_urls and len(result_dict) >= max_urls:
+                statistic_dict = take_over_min_statistic(result_dict, eviction_heap, request_url)
+            else:
+                statistic_dict = UrlStatistic(request_url, options)
+            result_dict[request_url] = statistic_dict
+            if eviction_heap:
+                heapq.heappush(eviction_heap, (statistic_dict.time_sum, request_url))
+        statistic_dict.count += 1
+        if sketch_error:
+            statistic_dict.times.add(response_time)
+        else:
+            statistic_dict.times.append(response_time)
+        statistic_dict.time_sum += response_time
+        if response_time > statistic_dict.time_max:
+            statistic_dict.time_max = response_time
+    return result_dict, line_counter, parsed_counter, err_counter
+
+
+class UrlStatistic:
+    # Statistics of one url. Slots instead of a dict per url and times in
+    # array('d') (8 bytes per time) instead of a list of float objects.
+    # times is a QuantileSketch when options.sketch_error is set,
+    # time_sum_error is None unless options.max_urls is set.
+    __slots__ = ('request_url', 'count', 'time_sum', 'time_max', 'time_sum_error', 'times')
+
+    def __init__(self, request_url, options=None):
+        options = options or DEFAULT_COUNT_OPTIONS
+        self.request_url = request_url
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        # upper bound of time_sum overestimation by heavy hitters counting
+        self.time_sum_error = 0.0 if options.max_urls else None
+        self.times = QuantileSketch(options.sketch_error) if options.sketch_error else array('d')
+
+    @property
+    def exact_time_sum(self):
+        # time_sum for report: summed in line order, sketch keeps it exact because
+        # chunks and checkpoints merge sketches in other order than lines
+        if isinstance(self.times, QuantileSketch):
+            return self.times.total()
+        return self.time_sum
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def take_over_min_statistic(result_dict, eviction_heap, request_url):
+    # Space-Saving weighted by time_sum: url with the least time_sum leaves
+    # and new url takes its counters, so totals stay exact and
+    # urls with big time_sum are never lost
+    if not eviction_heap:
+        eviction_heap.extend((statistic_dict.time_sum, url_key) for url_key, statistic_dict in result_dict.items())
+        heapq.heapify(eviction_heap)
+    while True:
+        time_sum, url_key = heapq.heappop(eviction_heap)
+        statistic_dict = result_dict.get(url_key)
+        if statistic_dict is None:
+            continue
+        if statistic_dict.time_sum != time_sum:
+            # time_sum has grown since the entry was pushed
+            heapq.heappush(eviction_heap, (statistic_dict.time_sum, url_key))
+            continue
+        del result_dict[url_key]
+        statistic_dict.request_url = request_url
+        statistic_dict.time_sum_error = statistic_dict.time_sum
+        return statistic_dict
+
+
+def count_statistics_in_chunk(chunk):
+    path, start, end, options, parser = chunk
+    return count_statistics(scan_lines_in_mmap(path, start, end, parser), options)
+
+
+def merge_statistics(result_dict, other_dict, max_urls=0):
+    # other_dict must hold lines which go after result_dict lines in file,
+    # times are added one by one so time_sum is the same as in serial counting
+    eviction_heap = []
+    for url_key, other in other_dict.items():
+        statistic_dict = result_dict.get(url_key)
+        if statistic_dict is None:
+            if not max_urls or len(result_dict) < max_urls:
+                result_dict[url_key] = other
+                if eviction_heap:
+                    heapq.heappush(eviction_heap, (other.time_sum, url_key))
+                continue
+            statistic_dict = result_dict[url_key] = take_over_min_statistic(result_dict, eviction_heap, url_key)
+        if max_urls:
+            statistic_dict.time_sum_error += other.time_sum_error
+        statistic_dict.count += other.count
+        statistic_dict.time_max = max(statistic_dict.time_max, other.time_max)
+        if isinstance(statistic_dict.times, QuantileSketch):
+            # report takes the exact sum from sketch, this one is for eviction and metrics
+            statistic_dict.time_sum += other.time_sum
+            statistic_dict.times.merge(other.times)
+        else:
+            for response_time in other.times:
+                statistic_dict.time_sum += response_time
+            statistic_dict.times.extend(other.times)
+        if eviction_heap:
+            heapq.heappush(eviction_heap, (statistic_dict.time_sum, url_key))
+    return result_dict
+
+
+def count_statistics_parallel(filecatcher_result_process, workers, options=None,
+                              checkpoint_path=None, error_monitor=None):
+    path = filecatcher_result_process.path
+    state, header = load_checkpoint(checkpoint_path, filecatcher_result_process, options)
+    offset = header['offset'] if header else 0
+    progress.resume(state, offset)
+    if error_monitor:
+        # chunks can't be stopped in the middle, so check the beginning first
+        error_monitor.check_sample(scan_lines_in_mmap(path, offset))
+    result_dict, line_counter, parsed_counter, err_counter = state or ({}, 0, 0, 0)
+    complete_end = find_complete_end(path)
+    # parser goes with chunks, registered formats may be unknown to worker processes
+    parser = log_formats.parser_for(path)
+    chunks = [(path, start, end, options, parser)
+              for start, end in split_file_to_chunks(path, workers, offset, complete_end)]
+    logging.info("Process file in %d chunks" % len(chunks))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map keeps chunks order, so urls and times are merged in file order
+        chunk_results = executor.map(count_statistics_in_chunk, chunks)
+        for chunk in chunks:
+            # chunks are parsed and counted in worker processes
+            with timers.stage('parallel_chunks'):
+                chunk_result = next(chunk_results)
+            with timers.stage('merge'):
+                merge_statistics(result_dict, chunk_result[0], (options or DEFAULT_COUNT_OPTIONS).max_urls)
+            line_counter += chunk_result[1]
+            parsed_counter += chunk_result[2]
+            err_counter += chunk_result[3]
+            progress.update((result_dict, line_counter, parsed_counter, err_counter), chunk[2])
+    state = result_dict, line_counter, parsed_counter, err_counter
+    if checkpoint_path:
+        save_checkpoint(checkpoint_path, filecatcher_result_process, options, state, complete_end,
+                        complete=True)
+    # last line without newline is counted, but not saved to checkpoint
+    return count_statistics(scan_lines_in_mmap(path, complete_end), options, state)
+
+
+def count_statistics_with_checkpoints(filecatcher_result_process, options=None,
+                                      checkpoint_path=None, checkpoint_lines=0, error_monitor=None):
+    state, header = load_checkpoint(checkpoint_path, filecatcher_result_process, options)
+    offset = header['offset'] if header else 0
+    progress.resume(state, offset)
+    if header and header['complete'] and filecatcher_result_process.ext == "gz":
+        # gz logs are not appended, complete checkpoint is the daily aggregate
+        return state
+    saved_lines = state[1] if state else 0
+    if error_monitor and filecatcher_result_process.ext == "log":
+        # mmap batches are large, so check the beginning of the log first
+        error_monitor.check_sample(scan_lines_in_mmap(filecatcher_result_process.path, offset))
+    for parsed_lines, end in timed_batches(process_batches_in_file(filecatcher_result_process, offset)):
+        if end is None and filecatcher_result_process.ext == "log":
+            # last line without newline is counted, but not saved to checkpoint
+            break
+        with timers.stage('aggregation'):
+            state = count_statistics(parsed_lines, options, state)
+        offset = end if end is not None else offset
+        progress.update(state, offset)
+        if error_monitor:
+            error_monitor.check(state[1], state[3])
+        if checkpoint_path and checkpoint_lines and state[1] - saved_lines >= checkpoint_lines:
+            save_checkpoint(checkpoint_path, filecatcher_result_process, options, state, offset)
+            saved_lines = state[1]
+    else:
+        parsed_lines = ()
+    state = state or ({}, 0, 0, 0)
+    if checkpoint_path and (not header or not header['complete'] or state[1] != saved_lines):
+        save_checkpoint(checkpoint_path, filecatcher_result_process, options, state, offset, complete=True)
+    with timers.stage('aggregation'):
+        return count_statistics(parsed_lines, options, state)
+
+
+CHECKPOINT_HEAD_SIZE = 4096
+# changed when the pickled state changes, older checkpoints are not loaded
+CHECKPOINT_FORMAT = 3
+
+
+def read_head(filecatcher_result_f, size=CHECKPOINT_HEAD_SIZE):
+    fopen = gzip.open if filecatcher_result_f.ext == "gz" else open
+    with fopen(filecatcher_result_f.path, 'rb') as file_item:
+        return file_item.read(size)
+
+
+@timed_stage('checkpoint')
+def save_checkpoint(checkpoint_path, filecatcher_result_f, options, state, offset, complete=False):
+    # checkpoint is two pickles: small header (offset and file identity) and state,
+    # so header can be checked without loading the whole state
+    header = {'path': os.path.abspath(filecatcher_result_f.path),
+              'head': read_head(filecatcher_result_f, min(offset, CHECKPOINT_HEAD_SIZE)),
+              'offset': offset,
+              'complete': complete,
+              'options': options_key(options),
+              'format': CHECKPOINT_FORMAT}
+    checkpoint_dir = os.path.dirname(checkpoint_path)
+    if checkpoint_dir and not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'wb') as checkpoint_file:
+        pickle.dump(header, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(state, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, checkpoint_path)
+    logging.debug("Saved checkpoint %s at byte %d, %d lines" % (checkpoint_path, offset, state[1]))
+
+
+def load_checkpoint_header(checkpoint_path, filecatcher_result_f, options=None):
+    if not checkpoint_path or not os.path.isfile(checkpoint_path):
+        return None
+    try:
+        with open(checkpoint_path, 'rb') as checkpoint_file:
+            header = pickle.load(checkpoint_file)
+    except Exception as err_checkpoint:
+        logging.info("Can't read checkpoint %s: %s" % (checkpoint_path, err_checkpoint))
+        return None
+    if header.get('format') != CHECKPOINT_FORMAT \
+            or header['path'] != os.path.abspath(filecatcher_result_f.path) \
+            or header['options'] != options_key(options) \
+            or header['head'] != read_head(filecatcher_result_f, len(header['head'])):
+        logging.info("Checkpoint %s is made for other file or settings" % checkpoint_path)
+        return None
+    return header
+
+
+def load_checkpoint(checkpoint_path, filecatcher_result_f, options=None):
+    # return (state, header) to resume from, (None, None) to start from scratch
+    if not load_checkpoint_header(checkpoint_path, filecatcher_result_f, options):
+        return None, None
+    try:
+        with open(checkpoint_path, 'rb') as checkpoint_file:
+            header = pickle.load(checkpoint_file)
+            state = pickle.load(checkpoint_file)
+    except Exception as err_checkpoint:
+        logging.info("Can't read checkpoint %s: %s" % (checkpoint_path, err_checkpoint))
+        return None, None
+    logging.info("Resume from checkpoint %s at byte %d" % (checkpoint_path, header['offset']))
+    return state, header
+
+
+def log_has_new_lines(filecatcher_result_f, checkpoint_path, options=None):
+    # plain log may be appended after the last analysis
+    if filecatcher_result_f.ext != "log":
+        return False
+    header = load_checkpoint_header(checkpoint_path, filecatcher_result_f, options)
+    if header is None:
+        return False
+    return find_complete_end(filecatcher_result_f.path) > header['offset']
+
+
+def count_statistics_in_file(filecatcher_result_process, workers=1, options=None,
+                             checkpoint_path=None, checkpoint_lines=0, error_monitor=None):
+    progress.start_file(filecatcher_result_process.path)
+    if workers > 1 and filecatcher_result_process.ext == "log":
+        return count_statistics_parallel(filecatcher_result_process, workers, options, checkpoint_path,
+                                         error_monitor)
+    return count_statistics_with_checkpoints(filecatcher_result_process, options,
+                                             checkpoint_path, checkpoint_lines, error_monitor)
+
+
+def merge_states(state, other_state, max_urls=0):
+    # other_state must be counted from lines after state lines (later file or day)
+    merge_statistics(state[0], other_state[0], max_urls)
+    return state[0], state[1] + other_state[1], state[2] + other_state[2], state[3] + other_state[3]
+
+
+def process_and_count_statistics_from_file_lines(filecatcher_result_process, error_ratio=0.2, workers=1,
+                                                 options=None, checkpoint_path=None, checkpoint_lines=0,
+                                                 error_sample_lines=0):
+    logging.info("Started process file")
+    state = count_statistics_in_file(filecatcher_result_process, workers, options,
+                                     checkpoint_path, checkpoint_lines,
+                                     ErrorBudgetMonitor(error_ratio, error_sample_lines))
+    return finalize_statistics(state, error_ratio)
+
+
+def process_and_count_statistics_from_files(filecatcher_results, error_ratio=0.2, workers=1,
+                                            options=None, checkpoint_dir=None, checkpoint_lines=0,
+                                            report_size=None, error_sample_lines=0):
+    # report over several days, every day aggregate is cached in checkpoint_dir
+    # after the first analysis, so old days are merged without parsing
+    state = None
+    for filecatcher_result_process in filecatcher_results:
+        logging.info("Started process file %s" % filecatcher_result_process.path)
+        checkpoint_path = checkpoint_path_for_date(checkpoint_dir, filecatcher_result_process.date,
+                                                   log_formats.for_path(filecatcher_result_process.path).name) \
+            if checkpoint_dir else None
+        day_state = count_statistics_in_file(filecatcher_result_process, workers, options,
+                                             checkpoint_path, checkpoint_lines,
+                                             ErrorBudgetMonitor(error_ratio, error_sample_lines))
+        state = day_state if state is None else merge_states(state, day_state,
+                                                             (options or DEFAULT_COUNT_OPTIONS).max_urls)
+    return finalize_statistics(state or ({}, 0, 0, 0), error_ratio, report_size)
+
+
+def checkpoint_path_for_date(checkpoint_dir, date, name=''):
+    # name of log format, '' for the default nginx-access-ui logs
+    return os.path.join(checkpoint_dir, 'checkpoint_%s%s.bin' % (name + '_' if name else '', date))
+
+
+@timed_stage('finalization')
+def finalize_statistics(state, error_ratio=0.2, report_size=None):
+    result_dict, line_counter, parsed_counter, err_counter = state
+    total_response_time = sum(statistic_dict.exact_time_sum for statistic_dict in result_dict.values())
     logging.info("total line counter %s\n"
                  "parsed counter %s\n"
                  "error counter %s\n"
@@ -139,27 +1252,47 @@ def process_and_count_statistics_from_file_lines(filecatcher_result_process, err
                                             total_response_time))
     # Count err_percentage if exceeds limit raise Exception
     if parsed_counter / line_counter < (1.0 - error_ratio):
-        logging.info('Wrong format. %d of %d lines parsed. '
-                     'More than %d%% of errors - failed parsing',
-                     parsed_counter, line_counter,
-                     int(error_ratio * 100))
-        raise RuntimeError('Wrong format, '
-                           '%d of %d lines parsed. '
-                           ', More than %d%% of errors - failed parsing' % (parsed_counter,
-                                                                            line_counter,
-                                                                            int(error_ratio * 100)))
-    # count median, percent etc in result_dict
-    for url_key in result_dict.keys():
-        result_dict[url_key]['time_med'] = median(result_dict[url_key].pop('time_list'))
-        result_dict[url_key]['time_perc'] = result_dict[url_key]['time_sum'] * 100 / total_response_time
-        result_dict[url_key]['count_perc'] = result_dict[url_key]['count'] * 100 / parsed_counter
-        result_dict[url_key]['time_avg'] = result_dict[url_key]['time_sum'] / result_dict[url_key]['count']
-    logging.info("End process file")
-    return list(result_dict.values())
+        raise_wrong_format(parsed_counter, line_counter, error_ratio)
+    if report_size is None:
+        rows = list(result_dict.values())
+    else:
+        # only top report_size urls by time_sum get to report, count median etc only for them
+        rows = select_top_rows(result_dict.values(), report_size, attrgetter('exact_time_sum'))
+    # count median, percent etc in rows
+    rows = [finalize_row(statistic_dict, total_response_time, parsed_counter) for statistic_dict in rows]
+    logging.info("End process statistics")
+    return rows
+
+
+def select_top_rows(rows, report_size, key=itemgetter('time_sum')):
+    # same rows and order as sorted(rows, reverse=True)[:report_size], but with bounded heap
+    return heapq.nlargest(report_size, rows, key=key)
+
+
+def finalize_row(url_statistic, total_response_time, parsed_counter):
+    # UrlStatistic to report row dict, urls are kept as bytes while parsing, decode once per url
+    statistic_dict = {'request_url': url_statistic.request_url.decode('utf-8', errors='replace'),
+                      'count': url_statistic.count,
+                      'time_sum': url_statistic.exact_time_sum,
+                      'time_max': url_statistic.time_max}
+    if url_statistic.time_sum_error is not None:
+        statistic_dict['time_sum_error'] = url_statistic.time_sum_error
+    if isinstance(url_statistic.times, QuantileSketch):
+        sketch = url_statistic.times
+        statistic_dict['time_med'] = sketch.quantile(0.5)
+        statistic_dict['time_p50'] = sketch.quantile(0.5)
+        statistic_dict['time_p95'] = sketch.quantile(0.95)
+        statistic_dict['time_p99'] = sketch.quantile(0.99)
+    else:
+        statistic_dict['time_med'] = median(url_statistic.times)
+    statistic_dict['time_perc'] = statistic_dict['time_sum'] * 100 / total_response_time
+    statistic_dict['count_perc'] = statistic_dict['count'] * 100 / parsed_counter
+    statistic_dict['time_avg'] = statistic_dict['time_sum'] / statistic_dict['count']
+    return statistic_dict
 
 
 def format_and_sort_to_json(result_table, report_size=1000):
-    return json.dumps(sorted(result_table, key=lambda k: k['time_sum'], reverse=True)[:report_size])
+    return json.dumps(select_top_rows(result_table, report_size))
 
 
 def json_render(jsontable, htmlfile_template_path):
@@ -171,48 +1304,400 @@ def json_render(jsontable, htmlfile_template_path):
         return r
 
 
+# template path -> (mtime, template split at $table_json placeholders)
+_split_templates = {}
+
+
+def split_template(htmlfile_template_path):
+    # Same text as Template.safe_substitute, but split at every $table_json,
+    # other placeholders are kept and $$ becomes $. Cached until template changes.
+    from string import Template
+    mtime = os.stat(htmlfile_template_path).st_mtime_ns
+    cached = _split_templates.get(htmlfile_template_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(htmlfile_template_path, 'rb') as htmlfile_path:
+        s = htmlfile_path.read().decode("utf-8")
+    parts, current, position = [], [], 0
+    for match in Template.pattern.finditer(s):
+        current.append(s[position:match.start()])
+        if match.group('escaped') is not None:
+            current.append(Template.delimiter)
+        elif (match.group('named') or match.group('braced')) == 'table_json':
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(match.group())
+        position = match.end()
+    current.append(s[position:])
+    parts.append(''.join(current))
+    _split_templates[htmlfile_template_path] = (mtime, parts)
+    return parts
+
+
+def write_json_rows(rows, output_file):
+    # same text as json.dumps(rows), written row by row
+    encoder = json.JSONEncoder()
+    output_file.write('[')
+    for number, row in enumerate(rows):
+        if number:
+            output_file.write(', ')
+        output_file.write(encoder.encode(row))
+    output_file.write(']')
+
+
+def json_render_to_file(rows, htmlfile_template_path, output_file):
+    # streaming json_render(json.dumps(rows), ...), the whole report is never built in memory
+    parts = split_template(htmlfile_template_path)
+    output_file.write(parts[0])
+    for part in parts[1:]:
+        write_json_rows(rows, output_file)
+        output_file.write(part)
+
+
+def write_report(result_list, report_size, htmlfile_template_path, report_result, export=False):
+    # with export the same rows are also written to report_<date>.bin by write_report_columns
+    report_path_dir = os.path.dirname(report_result)
+    if report_path_dir and not os.path.isdir(report_path_dir):
+        os.makedirs(report_path_dir)
+    rows = select_top_rows(result_list, report_size)
+    # report is streamed to a temporary file, so a failed run doesn't leave a partial report
+    tmp_report = report_result + '.tmp'
+    try:
+        with timers.stage('rendering'), open(tmp_report, 'w', encoding='utf-8') as f:
+            json_render_to_file(rows, htmlfile_template_path, f)
+    except Exception:
+        if os.path.isfile(tmp_report):
+            os.remove(tmp_report)
+        raise
+    os.replace(tmp_report, report_result)
+    if export:
+        write_report_columns(rows, columns_path_for_report(report_result))
+
+
+# Columnar report export: header, column table, then columns aligned to 8 bytes.
+# Numeric columns are arrays of native doubles ('d') or int64 ('q'), request_url
+# is 'q' offsets (rows + 1) followed by utf-8 blob. Rows are in report order.
+COLUMNS_MAGIC = b'LACOLS01'
+COLUMNS_HEADER = struct.Struct('<8s8sQQ')
+COLUMNS_ENTRY = struct.Struct('<16s8sQ')
+REPORT_COLUMNS = (('count', 'q'), ('count_perc', 'd'), ('time_sum', 'd'), ('time_perc', 'd'),
+                  ('time_avg', 'd'), ('time_max', 'd'), ('time_med', 'd'), ('time_p50', 'd'),
+                  ('time_p95', 'd'), ('time_p99', 'd'), ('time_sum_error', 'd'))
+
+
+def columns_path_for_report(report_result):
+    return os.path.splitext(report_result)[0] + '.bin'
+
+
+@timed_stage('export')
+def write_report_columns(rows, columns_path):
+    columns = [(name, typecode, array(typecode, (row[name] for row in rows)))
+               for name, typecode in REPORT_COLUMNS if rows and name in rows[0]]
+    urls = [row['request_url'].encode('utf-8') for row in rows]
+    url_offsets = array('q', [0])
+    for url in urls:
+        url_offsets.append(url_offsets[-1] + len(url))
+    columns.append(('request_url', 's', url_offsets.tobytes() + b''.join(urls)))
+    position = COLUMNS_HEADER.size + COLUMNS_ENTRY.size * len(columns)
+    entries, data = [], []
+    for name, typecode, column in columns:
+        position += -position % 8
+        entries.append(COLUMNS_ENTRY.pack(name.encode('ascii'), typecode.encode('ascii'), position))
+        data.append(column if isinstance(column, bytes) else column.tobytes())
+        position += len(data[-1])
+    tmp_path = columns_path + '.tmp'
+    with open(tmp_path, 'wb') as columns_file:
+        columns_file.write(COLUMNS_HEADER.pack(COLUMNS_MAGIC, sys.byteorder.encode('ascii'), len(rows), len(columns)))
+        columns_file.write(b''.join(entries))
+        for column in data:
+            columns_file.write(b'\0' * (-columns_file.tell() % 8))
+            columns_file.write(column)
+    os.replace(tmp_path, columns_path)
+
+
+class ReportColumns:
+    # Lazy reader of write_report_columns file: the file is mmap'ed and
+    # columns are memoryviews over it, rows are built only when asked.
+    def __init__(self, columns_path):
+        with open(columns_path, 'rb') as columns_file:
+            self.mapping = mmap.mmap(columns_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, self.rows_count, columns_count = COLUMNS_HEADER.unpack_from(self.mapping)
+        if magic != COLUMNS_MAGIC or byteorder.rstrip(b'\0').decode('ascii') != sys.byteorder:
+            self.mapping.close()
+            raise RuntimeError("Wrong report columns file %s" % columns_path)
+        self.columns = {}
+        view = memoryview(self.mapping)
+        for number in range(columns_count):
+            name, typecode, position = COLUMNS_ENTRY.unpack_from(self.mapping,
+                                                                 COLUMNS_HEADER.size + COLUMNS_ENTRY.size * number)
+            name, typecode = name.rstrip(b'\0').decode('ascii'), typecode.rstrip(b'\0').decode('ascii')
+            if typecode == 's':
+                self.url_offsets = view[position:position + 8 * (self.rows_count + 1)].cast('q')
+                self.url_data_start = position + 8 * (self.rows_count + 1)
+            else:
+                self.columns[name] = view[position:position + 8 * self.rows_count].cast(typecode)
+
+    def __len__(self):
+        return self.rows_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.columns.clear()
+        self.url_offsets.release()
+        self.mapping.close()
+
+    def column(self, name):
+        return self.columns[name]
+
+    def request_url(self, number):
+        start = self.url_data_start + self.url_offsets[number]
+        end = self.url_data_start + self.url_offsets[number + 1]
+        return self.mapping[start:end].decode('utf-8')
+
+    def row(self, number):
+        row = {'request_url': self.request_url(number)}
+        for name, column in self.columns.items():
+            row[name] = column[number]
+        return row
+
+    def top(self, count, column='time_sum'):
+        # rows are stored by time_sum, other columns are selected by bounded heap
+        if column == 'time_sum':
+            numbers = range(min(count, self.rows_count))
+        else:
+            numbers = heapq.nlargest(count, range(self.rows_count), key=self.columns[column].__getitem__)
+        return [self.row(number) for number in numbers]
+
+
+def count_options_from_config(config_dict):
+    max_urls = config_dict.get("MAX_URLS", 0)
+    sketch = config_dict.get("QUANTILE_SKETCH")
+    if max_urls and not sketch:
+        logging.info("MAX_URLS needs QUANTILE_SKETCH, times are counted in sketch")
+        sketch = True
+    return CountOptions(
+        config_dict.get("QUANTILE_SKETCH_ERROR", 0.01) if sketch else None,
+        UrlNormalizer(config_dict["URL_NORMALIZE"]) if config_dict.get("URL_NORMALIZE") else None,
+        max_urls)
+
+
 def main(config_dict):
+    # timings of stages are always logged and saved to report_<date>.timings.json,
+    # PROFILE adds report_<date>.prof of cProfile, TRACEMALLOC adds memory top to timings
+    register_log_formats(config_dict.get("LOG_FORMATS", {}))
+    for log_format in log_formats:
+        timers.reset()
+        profiler = cProfile.Profile() if config_dict.get("PROFILE") else None
+        if config_dict.get("TRACEMALLOC"):
+            tracemalloc.start()
+        if profiler:
+            profiler.enable()
+        report_result = None
+        try:
+            report_result = make_report(config_dict, log_format)
+        finally:
+            if profiler:
+                profiler.disable()
+            memory = tracemalloc_summary() if tracemalloc.is_tracing() else None
+            logging.info("Stage timings %s" % json.dumps(timers.as_dict()))
+        if report_result:
+            write_timings(report_result, profiler, memory)
+
+
+def tracemalloc_summary(top=10):
+    current, peak = tracemalloc.get_traced_memory()
+    statistics = tracemalloc.take_snapshot().statistics('lineno')[:top]
+    tracemalloc.stop()
+    return {'current_kb': current // 1024,
+            'peak_kb': peak // 1024,
+            'top': [{'line': str(statistic.traceback), 'size_kb': statistic.size // 1024, 'count': statistic.count}
+                    for statistic in statistics]}
+
+
+def write_timings(report_result, profiler=None, memory=None):
+    base_path = os.path.splitext(report_result)[0]
+    timings = {'report': report_result, 'stages': timers.as_dict()}
+    if profiler:
+        timings['profile'] = base_path + '.prof'
+        profiler.dump_stats(timings['profile'])
+    if memory:
+        timings['tracemalloc'] = memory
+    with open(base_path + '.timings.json', 'w') as timings_file:
+        json.dump(timings, timings_file, indent=2)
+
+
+def make_report(config_dict, log_format=None):
+    # returns path of written report or None, reports of not default
+    # log formats are named report_<format name>_<date>.html
+    log_format = log_format or log_formats.default
+    name_prefix = log_format.name + '_' if log_format.name else ''
+    log_index = config_dict.get("LOG_INDEX") or None
+    if log_index and log_format.name:
+        log_index = '%s.%s' % (log_index, log_format.name)
     try:
-        filecatcher_result = catchfile(config_dict.get("LOG_DIR", "."))
+        filecatcher_result = catchfile(config_dict.get("LOG_DIR", "."), log_index, log_format.file_pattern)
     except Exception as err_file:
         logging.debug(err_file)
         return
     if not filecatcher_result:
         return
     report_path_dir = config_dict.get("REPORT_DIR", ".")
-    report_file_name = 'report_%s.html' % filecatcher_result.date
+    count_options = count_options_from_config(config_dict)
+    checkpoint_lines = config_dict.get("CHECKPOINT_LINES", 0)
+    report_days = config_dict.get("REPORT_DAYS", 1)
+    if report_days > 1:
+        date_to = str_to_datetime(filecatcher_result.date)
+        date_from = date_to - datetime.timedelta(days=report_days - 1)
+        filecatcher_results = catch_files_in_range(config_dict.get("LOG_DIR", "."), date_from, date_to,
+                                                   log_index, log_format.file_pattern)
+        report_file_name = 'report_%s%s-%s.html' % (name_prefix, filecatcher_results[0].date,
+                                                    filecatcher_result.date)
+        # daily aggregates are always cached for date range reports
+        checkpoint_dir = report_path_dir
+    else:
+        filecatcher_results = [filecatcher_result]
+        report_file_name = 'report_%s%s.html' % (name_prefix, filecatcher_result.date)
+        checkpoint_dir = report_path_dir if checkpoint_lines else None
     report_result = os.path.join(report_path_dir, report_file_name)
     if os.path.isfile(report_result):
-        print("Report %s already done" % report_result)
-        logging.info("Report %s already done" % report_result)
-        return
+        updated_files = [item.path for item in filecatcher_results
+                         if checkpoint_dir and log_has_new_lines(item,
+                                                                 checkpoint_path_for_date(checkpoint_dir, item.date,
+                                                                                          log_format.name),
+                                                                 count_options)]
+        if not updated_files:
+            print("Report %s already done" % report_result)
+            logging.info("Report %s already done" % report_result)
+            return
+        logging.info("Logs %s have new lines, update report %s" % (", ".join(updated_files), report_result))
     try:
-        result_list = process_and_count_statistics_from_file_lines(filecatcher_result,
-                                                                   config_dict.get("PARSE_ERROR_PERC_MAX"))
+        result_list = process_and_count_statistics_from_files(filecatcher_results,
+                                                              config_dict.get("PARSE_ERROR_PERC_MAX"),
+                                                              config_dict.get("PARSE_WORKERS", 1),
+                                                              count_options,
+                                                              checkpoint_dir,
+                                                              checkpoint_lines,
+                                                              config_dict.get("REPORT_SIZE", 1000),
+                                                              config_dict.get("PARSE_ERROR_SAMPLE_LINES", 0))
     except Exception as err_result_list:
         logging.debug(err_result_list)
         return
 
     try:
-        result_json_table = format_and_sort_to_json(
-            result_list, config_dict.get("REPORT_SIZE", 1000))
+        write_report(result_list, config_dict.get("REPORT_SIZE", 1000), config_dict.get("REPORT_TEMPLATE"),
+                     report_result, config_dict.get("REPORT_EXPORT", False))
     except Exception as err_format_json:
         logging.debug(err_format_json)
         return
-
-    if not os.path.isdir(report_path_dir):
-        os.makedirs(report_path_dir)
-    with open(report_result, 'w') as f:
-        f.write(json_render(result_json_table, config_dict.get("REPORT_TEMPLATE")))
     print("You can find report at  %s" % report_result)
     logging.info("You can find report at  %s" % report_result)
+    return report_result
+
+
+class LogWatcher:
+    # Long-running mode: polls LOG_DIR, tails the latest log and keeps its
+    # statistics in memory. When a log with a newer date appears, the rest of
+    # the previous log is read and its daily report is written.
+    def __init__(self, config_dict):
+        self.config_dict = config_dict
+        self.log_index = LogDirIndex(config_dict.get("LOG_DIR", "."), config_dict.get("LOG_INDEX") or None)
+        self.count_options = count_options_from_config(config_dict)
+        self.report_dir = config_dict.get("REPORT_DIR", ".")
+        self.checkpoint_lines = config_dict.get("CHECKPOINT_LINES", 0)
+        self.logfile = None
+        self.state = None
+        self.offset = 0
+        self.saved_lines = 0
+        # gz log is not appended to, after the first full read polls skip it
+        self.finished = False
+
+    def checkpoint_path(self):
+        return checkpoint_path_for_date(self.report_dir, self.logfile.date) if self.checkpoint_lines else None
+
+    def start(self, logfile):
+        self.logfile = logfile
+        self.finished = False
+        self.state, header = load_checkpoint(self.checkpoint_path(), logfile, self.count_options)
+        self.offset = header['offset'] if header else 0
+        self.saved_lines = self.state[1] if self.state else 0
+        progress.start_file(logfile.path, self.offset)
+        progress.resume(self.state, self.offset)
+        logging.info("Watch %s from byte %d" % (logfile.path, self.offset))
+
+    def read_new_lines(self, final=False):
+        # unfinished last line of the active log is left for the next poll,
+        # complete lines before it come in a batch with offset
+        final = final or self.logfile.ext == 'gz'
+        for parsed_lines, end in timed_batches(process_batches_in_file(self.logfile, self.offset)):
+            if end is None and not final:
+                break
+            with timers.stage('aggregation'):
+                self.state = count_statistics(parsed_lines, self.count_options, self.state)
+            self.offset = end if end is not None else self.offset
+            progress.update(self.state, self.offset)
+        self.finished = self.logfile.ext == 'gz'
+        checkpoint_path = self.checkpoint_path()
+        if checkpoint_path and self.state and self.state[1] - self.saved_lines >= self.checkpoint_lines:
+            save_checkpoint(checkpoint_path, self.logfile, self.count_options, self.state, self.offset)
+            self.saved_lines = self.state[1]
+
+    def finish(self):
+        # previous log may be already compressed by logrotate, offsets are the same
+        logfiles = [item for item in self.log_index.logfiles() if item.date == self.logfile.date]
+        if logfiles and logfiles[0].path != self.logfile.path:
+            self.logfile = logfiles[0]
+            self.finished = False
+        if os.path.isfile(self.logfile.path) and not self.finished:
+            self.read_new_lines(final=True)
+        report_result = os.path.join(self.report_dir, 'report_%s.html' % self.logfile.date)
+        try:
+            result_list = finalize_statistics(self.state or ({}, 0, 0, 0),
+                                              self.config_dict.get("PARSE_ERROR_PERC_MAX"),
+                                              self.config_dict.get("REPORT_SIZE", 1000))
+            write_report(result_list, self.config_dict.get("REPORT_SIZE", 1000),
+                         self.config_dict.get("REPORT_TEMPLATE"), report_result,
+                         self.config_dict.get("REPORT_EXPORT", False))
+        except Exception as err_report:
+            logging.info("Report for %s failed: %s" % (self.logfile.path, err_report))
+            return
+        logging.info("You can find report at  %s" % report_result)
+
+    def poll(self):
+        latest = self.log_index.refresh().latest()
+        if latest is None:
+            return
+        if self.logfile and latest.date != self.logfile.date:
+            self.finish()
+            self.logfile = None
+        if not self.logfile:
+            self.start(latest)
+        if not self.finished:
+            self.read_new_lines()
+
+    def run(self, interval=60):
+        while True:
+            try:
+                self.poll()
+            except Exception as err_poll:
+                logging.exception("Watch poll failed %s" % err_poll)
+            time.sleep(interval)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", help="Config JSON file path", default=None)
+    parser.add_argument("--watch", help="Keep running and write daily reports on log rotation",
+                        action="store_true")
     args = parser.parse_args()
     config = init_config(args.config)
+    if args.watch:
+        config["WATCH"] = True
     logging.basicConfig(filename=config.get("REPORT_LOG", None),
                         level=logging.DEBUG if config.get("DEBUG", None) else logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s',
@@ -220,8 +1705,13 @@ if __name__ == "__main__":
     logging.info('START INFO logging')
     logging.debug('START DEBUG logging')
     logging.debug("get config parameters %s" % config)
+    if config.get("METRICS_PORT"):
+        start_metrics_server(config["METRICS_PORT"], config.get("METRICS_HOST", "127.0.0.1"))
     try:
-        main(config)
+        if config.get("WATCH"):
+            LogWatcher(config).run(config.get("WATCH_INTERVAL", 60))
+        else:
+            main(config)
     except KeyboardInterrupt as err:
         logging.exception("CTRL+C %s" % err)
     except Exception as err:
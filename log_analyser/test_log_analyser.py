@@ -1,9 +1,16 @@
 #!/usr/local/bin/python3
 # -*- coding: utf-8; -*-
 
+import gzip
+import json
+import os
+import tempfile
+import threading
 import unittest
 import log_analyzer
 from collections import namedtuple
+from operator import itemgetter
+from urllib.request import urlopen
 
 
 class LogAnalyzerTests(unittest.TestCase):
@@ -22,6 +29,27 @@ class LogAnalyzerTests(unittest.TestCase):
         self.assertEqual(log_analyzer.catchfile("./test_log_files"),
                          Logfile(path='./test_log_files/nginx-access-ui.log-20180818.gz', date='20180818', ext='gz'))
 
+    def test_log_dir_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir = os.path.join(tmp_dir, 'log')
+            os.makedirs(log_dir)
+            for name in ('nginx-access-ui.log-20180801.log', 'nginx-access-ui.log-20180802.gz',
+                         'nginx-access-ui.log-20181399.log', 'nginx-access-ui.log-20180803.bz'):
+                open(os.path.join(log_dir, name), 'w').close()
+            index_path = os.path.join(tmp_dir, 'log_index.bin')
+            self.assertEqual(log_analyzer.catchfile(log_dir, index_path).date, '20180802')
+            self.assertTrue(os.path.isfile(index_path))
+            open(os.path.join(log_dir, 'nginx-access-ui.log-20180804.log'), 'w').close()
+            os.remove(os.path.join(log_dir, 'nginx-access-ui.log-20180801.log'))
+            index = log_analyzer.LogDirIndex(log_dir, index_path)
+            self.assertEqual(sorted(index.entries), ['nginx-access-ui.log-20180801.log',
+                                                     'nginx-access-ui.log-20180802.gz'])
+            logfiles = index.refresh().in_range(log_analyzer.str_to_datetime('20180801'),
+                                                log_analyzer.str_to_datetime('20180803'))
+            self.assertEqual(logfiles, [log_analyzer.Logfile(os.path.join(log_dir, 'nginx-access-ui.log-20180802.gz'),
+                                                             '20180802', 'gz')])
+            self.assertEqual(index.latest().date, '20180804')
+
     def test_nginx_log_parser(self):
         line1 = "1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] \"" \
                 "GET /api/v2/banner/25019354 HTTP/1.1\"" \
@@ -31,6 +59,424 @@ class LogAnalyzerTests(unittest.TestCase):
         self.assertEqual(log_analyzer.nginx_log_parser(line1),
                          {'request_url': '/api/v2/banner/25019354', 'response_time': 0.39})
 
+    def test_nginx_line_parser(self):
+        line1 = b"1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] \"" \
+                b"GET /api/v2/banner/25019354 HTTP/1.1\"" \
+                b" 200 927 \"-\" \"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5\"" \
+                b" \"-\" \"1498697422-2190034393-4708-9752759\" \"dc7161be3\" 0.390\n"
+        self.assertEqual(log_analyzer.line_parser.parse(line1), (b'/api/v2/banner/25019354', 0.39))
+        self.assertEqual(log_analyzer.line_parser.parse(line1.replace(b' 0.390', b' -')),
+                         (b'/api/v2/banner/25019354', 0))
+        self.assertIs(log_analyzer.line_parser.parse(b"scjsdjlsdvjhcedj\n"), log_analyzer.PARSE_ERROR)
+
+    def test_compiled_log_format(self):
+        ui_format = '$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" ' \
+                    '$status $body_bytes_sent "$http_referer" "$http_user_agent" "$http_x_forwarded_for" ' \
+                    '"$http_X_REQUEST_ID" "$http_X_RB_USER" $request_time'
+        parser = log_analyzer.compile_log_format(ui_format)
+        self.assertIsInstance(parser, log_analyzer.FieldsLogParser)
+        with open('./test_log_files/nginx-access-ui.log-20180801.log', 'rb') as log_file:
+            for line in log_file:
+                expected = log_analyzer.line_parser.parse(line)
+                if expected is not log_analyzer.PARSE_ERROR:
+                    self.assertEqual(parser.parse(line), expected)
+        parser = log_analyzer.compile_log_format('$remote_addr [$time_local] "$request" $status rt=$request_time')
+        self.assertIsInstance(parser, log_analyzer.FieldsLogParser)
+        line = b'1.2.3.4 [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1" 200 rt=0.250\n'
+        self.assertEqual(parser.parse(line), (b'/api/1', 0.25))
+        self.assertIs(parser.parse(b'broken "line\n'), log_analyzer.PARSE_ERROR)
+        buffer = b'broken "line\n\n' + line + line[:-1]
+        self.assertEqual(list(parser.scan(buffer, 0, len(buffer))),
+                         [log_analyzer.PARSE_ERROR] * 2 + [(b'/api/1', 0.25)] * 2)
+        # user agent with spaces before the time, position depends on the value
+        parser = log_analyzer.compile_log_format('$remote_addr $http_user_agent $request_time "$request"')
+        self.assertIsInstance(parser, log_analyzer.RegexLogParser)
+        self.assertEqual(parser.parse(b'1.2.3.4 Mozilla/5.0 (X11) 0.5 "GET /a HTTP/1.1"\n'), (b'/a', 0.5))
+        with self.assertRaises(ValueError):
+            log_analyzer.compile_log_format('$remote_addr $status')
+
+    def test_main_reports_every_log_format(self):
+        self.addCleanup(log_analyzer.log_formats.formats.pop, 'api', None)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir = os.path.join(tmp_dir, 'log')
+            os.makedirs(log_dir)
+            with open('./test_log_files/nginx-access-ui.log-20180801.log', 'rb') as log_file, \
+                    open(os.path.join(log_dir, 'nginx-access-ui.log-20180801.log'), 'wb') as ui_file:
+                ui_file.write(log_file.read())
+            with open(os.path.join(log_dir, 'nginx-access-api.log-20180802.log'), 'w') as api_file:
+                for number in range(10):
+                    api_file.write('1.2.3.4 [02/Aug/2018:03:50:22 +0300] "GET /api/%d HTTP/1.1" 200 rt=0.%d\n'
+                                   % (number % 3, number))
+            config = log_analyzer.init_config()
+            config.update({"LOG_DIR": log_dir, "REPORT_DIR": tmp_dir, "PARSE_ERROR_PERC_MAX": 0.5,
+                           "LOG_FORMATS": {"api": {
+                               "file_pattern": r"^nginx-access-api.*?(?P<log_time>\d{8})\.(?P<ext>log|gz)$",
+                               "log_format": '$remote_addr [$time_local] "$request" $status rt=$request_time'}}})
+            log_analyzer.main(config)
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, 'report_20180801.html')))
+            with open(os.path.join(tmp_dir, 'report_api_20180802.html')) as report_file:
+                report = report_file.read()
+        self.assertIn('"request_url": "/api/0", "count": 4', report)
+
+    def test_scan_lines_in_mmap_same_as_parse(self):
+        path = './test_log_files/nginx-access-ui.log-20180801.log'
+        with open(path, 'rb') as log_file:
+            parsed = [log_analyzer.line_parser.parse(line) for line in log_file]
+        self.assertEqual(list(log_analyzer.scan_lines_in_mmap(path)), parsed)
+
+    def test_parallel_statistics_same_as_serial(self):
+        with open('./test_log_files/nginx-access-ui.log-20180801.log', 'rb') as log_file:
+            data = log_file.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # every url is in every chunk, so chunk sums are added in other order than lines
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180801.log')
+            with open(log_path, 'wb') as log_file:
+                log_file.write(data * 30)
+            logfile = log_analyzer.Logfile(log_path, '20180801', 'log')
+            for options in (None, log_analyzer.CountOptions(sketch_error=0.01)):
+                serial = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5, options=options)
+                parallel = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5, workers=3,
+                                                                                     options=options)
+                self.assertEqual(log_analyzer.format_and_sort_to_json(serial),
+                                 log_analyzer.format_and_sort_to_json(parallel))
+
+    def test_gzip_statistics_same_as_plain(self):
+        path = './test_log_files/nginx-access-ui.log-20180801.log'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gz_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180801.gz')
+            with open(path, 'rb') as log_file, gzip.open(gz_path, 'wb') as gz_file:
+                gz_file.write(log_file.read())
+            plain = log_analyzer.process_and_count_statistics_from_file_lines(
+                log_analyzer.Logfile(path, '20180801', 'log'), 0.5)
+            packed = log_analyzer.process_and_count_statistics_from_file_lines(
+                log_analyzer.Logfile(gz_path, '20180801', 'gz'), 0.5)
+        self.assertEqual(plain, packed)
+
+    def test_split_blocks_to_lines(self):
+        blocks = [b'first\nsec', b'ond\nthi', b'rd']
+        batches = list(log_analyzer.split_blocks_to_lines(blocks))
+        self.assertEqual(batches, [([b'first'], 6), ([b'second'], 13), ([], 13), ([b'third'], None)])
+
+    def test_resume_from_checkpoint(self):
+        path = './test_log_files/nginx-access-ui.log-20180801.log'
+        with open(path, 'rb') as log_file:
+            data = log_file.read()
+        middle = data.index(b'\n', len(data) // 2) + 1
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180801.log')
+            checkpoint_path = os.path.join(tmp_dir, 'checkpoint_20180801.bin')
+            logfile = log_analyzer.Logfile(log_path, '20180801', 'log')
+            # log is appended while it is analyzed
+            with open(log_path, 'wb') as log_file:
+                log_file.write(data[:middle])
+            log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5,
+                                                                      checkpoint_path=checkpoint_path,
+                                                                      checkpoint_lines=10)
+            self.assertFalse(log_analyzer.log_has_new_lines(logfile, checkpoint_path))
+            with open(log_path, 'ab') as log_file:
+                log_file.write(data[middle:])
+            self.assertTrue(log_analyzer.log_has_new_lines(logfile, checkpoint_path))
+            resumed = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5,
+                                                                                checkpoint_path=checkpoint_path,
+                                                                                checkpoint_lines=10)
+            # lines from checkpoint are not counted again in lines_per_sec
+            self.assertEqual(log_analyzer.progress.started_lines, data[:middle].count(b'\n'))
+        full = log_analyzer.process_and_count_statistics_from_file_lines(
+            log_analyzer.Logfile(path, '20180801', 'log'), 0.5)
+        self.assertEqual(resumed, full)
+
+    def test_checkpoint_before_unfinished_line(self):
+        with open('./test_log_files/nginx-access-ui.log-20180801.log', 'rb') as log_file:
+            data = log_file.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180801.log')
+            checkpoint_path = os.path.join(tmp_dir, 'checkpoint_20180801.bin')
+            logfile = log_analyzer.Logfile(log_path, '20180801', 'log')
+            # nginx is writing the last line
+            with open(log_path, 'wb') as log_file:
+                log_file.write(data + data[:40])
+            rows = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5,
+                                                                             checkpoint_path=checkpoint_path)
+            header = log_analyzer.load_checkpoint_header(checkpoint_path, logfile)
+            self.assertEqual(header['offset'], len(data))
+            self.assertFalse(log_analyzer.log_has_new_lines(logfile, checkpoint_path))
+            self.assertEqual(rows, log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5))
+
+    def test_date_range_statistics_from_cached_days(self):
+        path = './test_log_files/nginx-access-ui.log-20180801.log'
+        with open(path, 'rb') as log_file:
+            data = log_file.read()
+        middle = data.index(b'\n', len(data) // 2) + 1
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for date, day_data in (('20180801', data[:middle]), ('20180802', data[middle:])):
+                with open(os.path.join(tmp_dir, 'nginx-access-ui.log-%s.log' % date), 'wb') as log_file:
+                    log_file.write(day_data)
+            logfiles = log_analyzer.catch_files_in_range(tmp_dir,
+                                                         log_analyzer.str_to_datetime('20180731'),
+                                                         log_analyzer.str_to_datetime('20180802'))
+            self.assertEqual([logfile.date for logfile in logfiles], ['20180801', '20180802'])
+            first = log_analyzer.process_and_count_statistics_from_files(logfiles, 0.5, checkpoint_dir=tmp_dir)
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, 'checkpoint_20180801.bin')))
+            cached = log_analyzer.process_and_count_statistics_from_files(logfiles, 0.5, checkpoint_dir=tmp_dir)
+        full = log_analyzer.process_and_count_statistics_from_file_lines(
+            log_analyzer.Logfile(path, '20180801', 'log'), 0.5)
+        self.assertEqual(first, full)
+        self.assertEqual(cached, full)
+
+    def test_watcher_reports_rotated_log(self):
+        path = './test_log_files/nginx-access-ui.log-20180801.log'
+        with open(path, 'rb') as log_file:
+            data = log_file.read()
+        middle = data.index(b'\n', len(data) // 2) + 10
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir = os.path.join(tmp_dir, 'log')
+            os.makedirs(log_dir)
+            config = {"LOG_DIR": log_dir, "REPORT_DIR": tmp_dir, "REPORT_SIZE": 1000,
+                      "REPORT_TEMPLATE": "./templates/report.html", "PARSE_ERROR_PERC_MAX": 0.5}
+            watcher = log_analyzer.LogWatcher(config)
+            day_path = os.path.join(log_dir, 'nginx-access-ui.log-20180801.log')
+            with open(day_path, 'wb') as log_file:
+                log_file.write(data[:middle])
+            watcher.poll()
+            with open(day_path, 'ab') as log_file:
+                log_file.write(data[middle:])
+            watcher.poll()
+            # rotation: the day is compressed and the next day starts
+            with gzip.open(day_path[:-3] + 'gz', 'wb') as log_file:
+                log_file.write(data)
+            os.remove(day_path)
+            open(os.path.join(log_dir, 'nginx-access-ui.log-20180802.log'), 'w').close()
+            watcher.poll()
+            self.assertEqual(watcher.logfile.date, '20180802')
+            with open(os.path.join(tmp_dir, 'report_20180801.html')) as report_file:
+                watched = report_file.read()
+            rows = log_analyzer.process_and_count_statistics_from_file_lines(
+                log_analyzer.Logfile(path, '20180801', 'log'), 0.5)
+            expected_path = os.path.join(tmp_dir, 'expected.html')
+            log_analyzer.write_report(rows, 1000, "./templates/report.html", expected_path)
+            with open(expected_path) as report_file:
+                self.assertEqual(watched, report_file.read())
+
+    def test_watcher_counts_lines_before_unfinished_line(self):
+        with open('./test_log_files/nginx-access-ui.log-20180801.log', 'rb') as log_file:
+            data = log_file.read() * 50
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir = os.path.join(tmp_dir, 'log')
+            os.makedirs(log_dir)
+            watcher = log_analyzer.LogWatcher({"LOG_DIR": log_dir, "REPORT_DIR": tmp_dir})
+            day_path = os.path.join(log_dir, 'nginx-access-ui.log-20180801.log')
+            # poll while nginx is writing a line
+            with open(day_path, 'wb') as log_file:
+                log_file.write(data + data[:40])
+            watcher.poll()
+            self.assertEqual((watcher.state[1], watcher.offset), (4100, len(data)))
+            with open(day_path, 'ab') as log_file:
+                log_file.write(data[40:data.index(b'\n') + 1])
+            watcher.poll()
+            self.assertEqual((watcher.state[1], watcher.offset), (4101, data.index(b'\n') + 1 + len(data)))
+
+    def test_watcher_reads_gz_log_once(self):
+        with open('./test_log_files/nginx-access-ui.log-20180801.log', 'rb') as log_file:
+            data = log_file.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir = os.path.join(tmp_dir, 'log')
+            os.makedirs(log_dir)
+            watcher = log_analyzer.LogWatcher({"LOG_DIR": log_dir, "REPORT_DIR": tmp_dir, "REPORT_SIZE": 1000,
+                                               "REPORT_TEMPLATE": "./templates/report.html",
+                                               "PARSE_ERROR_PERC_MAX": 0.5})
+            day_path = os.path.join(log_dir, 'nginx-access-ui.log-20180801.gz')
+            with gzip.open(day_path, 'wb') as log_file:
+                log_file.write(data)
+            watcher.poll()
+            self.assertEqual((watcher.state[1], watcher.finished), (82, True))
+            # archive is not read again, even if it is replaced
+            with gzip.open(day_path, 'wb') as log_file:
+                log_file.write(data * 2)
+            watcher.poll()
+            self.assertEqual(watcher.state[1], 82)
+            open(os.path.join(log_dir, 'nginx-access-ui.log-20180802.log'), 'w').close()
+            watcher.poll()
+            self.assertEqual((watcher.logfile.date, watcher.finished), ('20180802', False))
+            with open(os.path.join(tmp_dir, 'report_20180801.html')) as report_file:
+                self.assertIn('"count": ', report_file.read())
+
+    def test_metrics_endpoint(self):
+        logfile = log_analyzer.Logfile('./test_log_files/nginx-access-ui.log-20180801.log', '20180801', 'log')
+        rows = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5)
+        server = log_analyzer.start_metrics_server(0)
+        try:
+            with urlopen('http://127.0.0.1:%d/metrics?top=3' % server.server_address[1]) as response:
+                metrics = json.loads(response.read().decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(metrics['path'], logfile.path)
+        self.assertEqual((metrics['lines'], metrics['parsed']), (82, 54))
+        self.assertEqual(metrics['bytes_processed'], os.path.getsize(logfile.path))
+        self.assertEqual([row['request_url'] for row in metrics['top']],
+                         [row['request_url'] for row in log_analyzer.select_top_rows(rows, 3)])
+
+    def test_progress_lines_per_sec_after_resume(self):
+        metrics = log_analyzer.ProgressMetrics()
+        metrics.start_file('nginx-access-ui.log-20180801.log', 500)
+        metrics.resume(({}, 1000, 900, 100), 500)
+        metrics.update(({}, 1010, 910, 100), 600)
+        metrics.started -= 2
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['lines'], 1010)
+        self.assertAlmostEqual(snapshot['lines_per_sec'], 5, places=1)
+        # next file counts from zero
+        metrics.start_file('nginx-access-ui.log-20180802.log')
+        metrics.update(({}, 20, 20, 0), 100)
+        metrics.started -= 2
+        self.assertAlmostEqual(metrics.snapshot()['lines_per_sec'], 10, places=1)
+
+    def test_main_writes_stage_timings(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir = os.path.join(tmp_dir, 'log')
+            os.makedirs(log_dir)
+            with open('./test_log_files/nginx-access-ui.log-20180801.log', 'rb') as log_file, \
+                    gzip.open(os.path.join(log_dir, 'nginx-access-ui.log-20180801.gz'), 'wb') as gz_file:
+                gz_file.write(log_file.read())
+            config = log_analyzer.init_config()
+            config.update({"LOG_DIR": log_dir, "REPORT_DIR": tmp_dir, "PARSE_ERROR_PERC_MAX": 0.5,
+                           "TRACEMALLOC": True})
+            log_analyzer.main(config)
+            with open(os.path.join(tmp_dir, 'report_20180801.timings.json')) as timings_file:
+                timings = json.load(timings_file)
+        self.assertLessEqual({'discovery', 'decompression', 'parsing', 'aggregation', 'finalization', 'rendering'},
+                             set(timings['stages']))
+        self.assertGreater(timings['tracemalloc']['peak_kb'], 0)
+
+    def test_top_rows_same_as_full_sort(self):
+        logfile = log_analyzer.Logfile('./test_log_files/nginx-access-ui.log-20180801.log', '20180801', 'log')
+        full = log_analyzer.process_and_count_statistics_from_files([logfile], 0.5)
+        top = log_analyzer.process_and_count_statistics_from_files([logfile], 0.5, report_size=10)
+        self.assertEqual(top, sorted(full, key=lambda k: k['time_sum'], reverse=True)[:10])
+
+    def test_streamed_report_same_as_json_render(self):
+        logfile = log_analyzer.Logfile('./test_log_files/nginx-access-ui.log-20180801.log', '20180801', 'log')
+        rows = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = os.path.join(tmp_dir, 'report.html')
+            with open(template_path, 'w') as template_file:
+                template_file.write('<a>$$x $other ${table_json}</a><b>$table_json</b>')
+            for report_size in (0, 1, 1000):
+                report_path = os.path.join(tmp_dir, 'report.html.out')
+                with open(report_path, 'w') as report_file:
+                    log_analyzer.json_render_to_file(log_analyzer.select_top_rows(rows, report_size),
+                                                     template_path, report_file)
+                with open(report_path) as report_file:
+                    self.assertEqual(report_file.read(), log_analyzer.json_render(
+                        log_analyzer.format_and_sort_to_json(rows, report_size), template_path))
+
+    def test_report_columns_export(self):
+        logfile = log_analyzer.Logfile('./test_log_files/nginx-access-ui.log-20180801.log', '20180801', 'log')
+        rows = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, 'report_20180801.html')
+            log_analyzer.write_report(rows, 1000, './templates/report.html', report_path, export=True)
+            with log_analyzer.ReportColumns(os.path.join(tmp_dir, 'report_20180801.bin')) as columns:
+                self.assertEqual(len(columns), len(rows))
+                self.assertEqual(columns.top(5), log_analyzer.select_top_rows(rows, 5))
+                self.assertEqual(columns.top(3, 'count'),
+                                 log_analyzer.select_top_rows(columns.top(len(rows)), 3, itemgetter('count')))
+
+    def test_url_normalizer(self):
+        normalizer = log_analyzer.UrlNormalizer(["strip_query", "collapse_ids", [r"^/api/v\d+/", "/api/"]])
+        self.assertEqual(normalizer(b'/api/v2/banner/25019354'), b'/api/banner/{id}')
+        self.assertEqual(normalizer(b'/api/1/photogenic_banners/list/?server_name=WIN7RB4'),
+                         b'/api/{id}/photogenic_banners/list/')
+
+    def test_max_urls_keeps_heavy_hitters(self):
+        logfile = log_analyzer.Logfile('./test_log_files/nginx-access-ui.log-20180801.log', '20180801', 'log')
+        full = log_analyzer.process_and_count_statistics_from_file_lines(logfile, 0.5)
+        for workers in (1, 3):
+            capped = log_analyzer.process_and_count_statistics_from_file_lines(
+                logfile, 0.5, workers, log_analyzer.CountOptions(sketch_error=0.01, max_urls=5))
+            self.assertEqual(len(capped), 5)
+            self.assertAlmostEqual(sum(row['time_sum'] for row in capped), sum(row['time_sum'] for row in full))
+            # url with more than 1/max_urls of total time is never evicted
+            top_full = max(full, key=lambda k: k['time_sum'])
+            self.assertIn(top_full['request_url'], [row['request_url'] for row in capped])
+        with self.assertRaises(ValueError):
+            log_analyzer.count_statistics([], log_analyzer.CountOptions(max_urls=5))
+        options = log_analyzer.count_options_from_config({"MAX_URLS": 5})
+        self.assertEqual((options.sketch_error, options.max_urls), (0.01, 5))
+
+    def test_error_budget_monitor_stops_early(self):
+        monitor = log_analyzer.ErrorBudgetMonitor(0.1, sample_lines=1000)
+        monitor.check(999, 999)
+        # about 10% of errors is not enough to stop before the end
+        monitor.check(1000, 120)
+        monitor.check(4000, 440)
+        with self.assertRaises(RuntimeError):
+            monitor.check(8000, 4000)
+
+    def test_malformed_gz_stops_early(self):
+        errors = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gz_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180801.gz')
+            # reader fills the block queue and waits to put the end of file when parsing stops
+            with gzip.open(gz_path, 'wb') as gz_file:
+                gz_file.write(b'broken line 000\n' * (5 * log_analyzer.READ_BLOCK_SIZE // 16))
+
+            def process():
+                try:
+                    log_analyzer.process_and_count_statistics_from_file_lines(
+                        log_analyzer.Logfile(gz_path, '20180801', 'gz'), 0.1, error_sample_lines=10000)
+                except RuntimeError as err_process:
+                    errors.append(err_process)
+
+            thread = threading.Thread(target=process, daemon=True)
+            thread.start()
+            thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+    def test_split_file_to_chunks(self):
+        path = './test_log_files/nginx-access-ui.log-20180801.log'
+        chunks = log_analyzer.split_file_to_chunks(path, 4)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], os.path.getsize(path))
+        with open(path, 'rb') as log_file:
+            data = log_file.read()
+        for start, end in chunks:
+            self.assertEqual(data[end - 1:end], b'\n')
+
+    def test_quantile_sketch(self):
+        values = [i / 1000 for i in range(1, 10001)]
+        sketch = log_analyzer.QuantileSketch(0.01)
+        other = log_analyzer.QuantileSketch(0.01)
+        for value in values[:5000]:
+            sketch.add(value)
+        for value in values[5000:]:
+            other.add(value)
+        sketch.merge(other)
+        self.assertEqual(sketch.count, len(values))
+        for q in (0.5, 0.95, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q), exact, delta=exact * 0.01)
+
+    def test_resume_with_sketch_statistics(self):
+        path = './test_log_files/nginx-access-ui.log-20180801.log'
+        options = log_analyzer.CountOptions(sketch_error=0.01)
+        full = log_analyzer.process_and_count_statistics_from_file_lines(
+            log_analyzer.Logfile(path, '20180801', 'log'), 0.5, options=options)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180801.log')
+            with open(path, 'rb') as log_file, open(log_path, 'wb') as tmp_log_file:
+                tmp_log_file.write(log_file.read())
+            checkpoint_path = os.path.join(tmp_dir, 'checkpoint_20180801.bin')
+            logfile = log_analyzer.Logfile(log_path, '20180801', 'log')
+            first = log_analyzer.process_and_count_statistics_from_file_lines(
+                logfile, 0.5, options=options, checkpoint_path=checkpoint_path)
+            resumed = log_analyzer.process_and_count_statistics_from_file_lines(
+                logfile, 0.5, options=options, checkpoint_path=checkpoint_path)
+        self.assertEqual(first, full)
+        self.assertEqual(resumed, full)
+        self.assertTrue(all('time_p95' in row for row in full))
+
 
 if __name__ == "__main__":
     unittest.main()